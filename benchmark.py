@@ -0,0 +1,421 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+import capture
+
+# Banner pygame tercetak ke stdout saat import dan akan merusak keluaran JSON
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import client
+import server
+
+# Benchmark end-to-end lewat loopback: server asyncio dan client headless
+# (thread jaringan, decode dan scale tanpa jendela pygame) berjalan di satu
+# proses dengan layar sintetis dan injector input recording. Hasil berupa JSON
+# agar bisa dibandingkan antar perubahan QUALITY, SCREEN_SCALE dan encoder.
+
+RESOLUTIONS = ["1280x720", "1920x1080"]
+QUALITIES = [40, 60, 80]
+SCENES = list(capture.SyntheticCapture.scenes)
+
+
+class StageTimer:
+    # Akumulasi waktu CPU per tahap; time.thread_time() hanya menghitung
+    # thread pemanggil sehingga pekerjaan di pool encode/decode tetap tercatat
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = time.thread_time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.add(stage, time.thread_time() - start)
+
+        setattr(owner, name, timed)
+        return original
+
+    def add(self, stage, seconds):
+        with self.lock:
+            total, count = self.totals.get(stage, (0.0, 0))
+            self.totals[stage] = (total + seconds, count + 1)
+
+    def reset(self):
+        with self.lock:
+            self.totals = {}
+
+    def report(self, frames):
+        with self.lock:
+            return {
+                stage: {
+                    "calls": count,
+                    "cpu_ms_total": round(total * 1000, 2),
+                    "cpu_ms_per_frame": round(total * 1000 / max(frames, 1), 3),
+                }
+                for stage, (total, count) in sorted(self.totals.items())
+            }
+
+
+class LatencyProbe:
+    # Mencocokkan frame yang ditulis server dengan pesan yang di-decode client.
+    # Stream TCP menjaga urutan, jadi cukup FIFO berisi waktu capture terbaru
+    # yang terkandung di setiap frame yang ditulis.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_capture = None
+        self.published = None
+        self.written = deque()
+        self.received = {}
+        self.samples = []
+        self.bytes_received = 0
+
+    def on_grab(self, timestamp):
+        self.last_capture = timestamp
+
+    def on_publish(self, rects):
+        if rects:
+            self.published = self.last_capture
+
+    def on_write(self):
+        with self.lock:
+            self.written.append(self.published)
+
+    def on_submit(self, payload):
+        with self.lock:
+            timestamp = self.written.popleft() if self.written else None
+            self.bytes_received += len(payload)
+        self.received[id(payload)] = timestamp
+
+    def on_decoded(self, payload):
+        timestamp = self.received.pop(id(payload), None)
+        if timestamp is not None:
+            with self.lock:
+                self.samples.append((time.perf_counter() - timestamp) * 1000)
+
+    def reset(self):
+        # Hanya sampel; FIFO written/received tetap karena frame yang sedang
+        # di jalan saat pengukuran dimulai masih harus dipasangkan
+        with self.lock:
+            self.samples = []
+            self.bytes_received = 0
+
+    def report(self):
+        with self.lock:
+            samples = np.array(self.samples) if self.samples else np.zeros(1)
+            return {
+                "p50": round(float(np.percentile(samples, 50)), 2),
+                "p99": round(float(np.percentile(samples, 99)), 2),
+                "mean": round(float(samples.mean()), 2),
+                "max": round(float(samples.max()), 2),
+            }
+
+
+timer = StageTimer()
+probe = LatencyProbe()
+
+
+class BenchmarkCapture(capture.SyntheticCapture):
+    name = "benchmark"
+
+    def grab(self):
+        probe.on_grab(time.perf_counter())
+        start = time.thread_time()
+        frame = super().grab()
+        timer.add("server.grab", time.thread_time() - start)
+        return frame
+
+
+capture.CAPTURE_BACKENDS[BenchmarkCapture.name] = BenchmarkCapture
+
+
+def install_probes():
+    timer.wrap(server.ScreenEncoder, "scale_frame", "server.scale")
+    timer.wrap(server, "find_dirty_tiles", "server.diff")
+    timer.wrap(server, "encode_jpeg", "server.encode")
+    timer.wrap(server, "classify_region", "server.classify")
+    timer.wrap(server, "encode_palette", "server.palette")
+    timer.wrap(server, "find_scroll", "server.scroll")
+    timer.wrap(server, "tile_key", "server.tile_key")
+    timer.wrap(server.BlockMotionCodec, "encode", "server.motion")
+    timer.wrap(client, "decode_image", "client.decode")
+    timer.wrap(client, "decode_palette", "client.palette")
+    timer.wrap(client, "decode_motion", "client.motion")
+
+    timer.wrap(server.FrameHub, "publish", "server.publish")
+    timer.wrap(server.ClientOutbox, "write_frame", "server.send")
+    timer.wrap(client.DecodeStage, "decode", "client.apply")
+    submit = client.DecodeStage.submit
+    timed_publish = server.FrameHub.publish
+    timed_write = server.ClientOutbox.write_frame
+    timed_decode = client.DecodeStage.decode
+
+    def probed_publish(self, rects, *args):
+        probe.on_publish(rects)
+        return timed_publish(self, rects, *args)
+
+    def probed_write(self, update):
+        probe.on_write()
+        return timed_write(self, update)
+
+    def probed_submit(self, buffer, payload, width, height, info=None):
+        probe.on_submit(payload)
+        return submit(self, buffer, payload, width, height, info)
+
+    def probed_decode(self, payload, width, height, info=None):
+        timed_decode(self, payload, width, height, info)
+        probe.on_decoded(payload)
+
+    server.FrameHub.publish = probed_publish
+    server.ClientOutbox.write_frame = probed_write
+    client.DecodeStage.submit = probed_submit
+    client.DecodeStage.decode = probed_decode
+
+
+class ServerThread(threading.Thread):
+    def __init__(self, capture_options):
+        super().__init__(daemon=True, name="benchmark-server")
+        self.capture_options = capture_options
+        self.loop = None
+        self.task = None
+        self.started = threading.Event()
+
+    def run(self):
+        # asyncio.run membatalkan koneksi yang masih terbuka sebelum loop ditutup
+        try:
+            asyncio.run(self.serve())
+        except asyncio.CancelledError:
+            pass
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.started.set()
+        await server.serve(BenchmarkCapture.name, self.capture_options)
+
+    def stop(self):
+        self.started.wait()
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        self.join(5.0)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def input_load(rate, stop):
+    # Gerakan mouse sintetis dari client selama pengukuran, dengan sesekali
+    # burst TYPE_TEXT, agar tahap "input" server punya sampel
+    index = 0
+    while not stop.wait(1.0 / rate):
+        client.queue_command("MOUSE_MOVE", index % client.WINDOW_WIDTH, (index * 7) % client.WINDOW_HEIGHT,
+                             client.WINDOW_WIDTH, client.WINDOW_HEIGHT)
+        if index % 50 == 0:
+            client.queue_command("TYPE_TEXT", json.dumps("echo benchmark\n"))
+        index += 1
+
+
+def reset_state():
+    global probe
+    # Probe baru per kasus: antrean frame kasus sebelumnya tidak boleh
+    # dipasangkan dengan paket koneksi baru
+    probe = LatencyProbe()
+    server.frame_hubs = server.ViewportHubs()
+    server.active_outboxes.clear()
+    server.parked_sessions.clear()
+    server.stop_event.clear()
+    server.capture_source = None
+
+    client.connected = False
+    client.running = True
+    client.framebuffer = None
+    client.framebuffer_size = (0, 0)
+    client.frame_version = 0
+    client.frames_dropped = 0
+    client.session_token = None
+    client.applied_seq = -1
+    client.motion_reference = None
+    client.clock_sync = client.ClockSync()
+    client.scale_stage = client.ScaleStage()
+
+
+def run_case(width, height, quality, scene, args):
+    reset_state()
+    server.HOST = "127.0.0.1"
+    server.PORT = free_port()
+    server.QUALITY = quality
+    server.SCREEN_SCALE = args.scale
+    server.FPS_LIMIT = args.fps
+    server.ADAPTIVE_QUALITY = False
+    # RateController mencari pengaturan ini di QUALITY_LEVELS
+    server.QUALITY_LEVELS = [(quality, args.scale, args.fps)]
+    server.INPUT_INJECTOR = "recording"
+    server.CONTENT_AWARE = args.content_aware
+    server.SCROLL_DETECTION = args.scroll
+    server.TILE_CACHE_ENTRIES = args.cache_entries
+    server.MOTION_CODEC = args.motion_codec
+
+    client.SERVER_IP = server.HOST
+    client.PORT = server.PORT
+    client.ADAPTIVE_QUALITY = False
+    client.REDUCED_DECODE = False
+    client.TILE_CACHE_ENTRIES = args.cache_entries
+    client.viewport_region = tuple(args.region) if args.region else None
+    client.WINDOW_WIDTH, client.WINDOW_HEIGHT = args.window or (int(width * args.scale), int(height * args.scale))
+
+    server_thread = ServerThread({"width": width, "height": height, "scene": scene})
+    server_thread.start()
+    deadline = time.time() + 10.0
+    while server.capture_source is None and time.time() < deadline:
+        time.sleep(0.01)
+
+    network = threading.Thread(target=client.network_thread, daemon=True, name="benchmark-client")
+    network.start()
+    client.scale_stage.resize(client.WINDOW_WIDTH, client.WINDOW_HEIGHT)
+    threading.Thread(target=client.scale_stage.run, daemon=True, name="benchmark-scale").start()
+
+    # Keyframe pertama dan pemanasan pool tidak ikut diukur
+    time.sleep(args.warmup)
+    timer.reset()
+    probe.reset()
+    server.stage_timings.reset()
+    client.stage_timings.reset()
+    start_version = client.frame_version
+    start_events = server.input_executor.injector.events
+    start_cpu = time.process_time()
+    start_time = time.perf_counter()
+
+    input_stop = threading.Event()
+    if args.input_rate > 0:
+        threading.Thread(target=input_load, args=(args.input_rate, input_stop), daemon=True).start()
+    time.sleep(args.duration)
+    input_stop.set()
+
+    elapsed = time.perf_counter() - start_time
+    cpu = time.process_time() - start_cpu
+    frames = client.frame_version - start_version
+    latency = probe.report()
+    stages = timer.report(frames)
+    stage_latency = {"server": server.stage_timings.summary(), "client": client.stage_timings.summary()}
+    received = probe.bytes_received
+    input_events = server.input_executor.injector.events - start_events
+
+    client.running = False
+    network.join(5.0)
+    with client.frame_changed:
+        client.frame_changed.notify_all()
+    server_thread.stop()
+
+    return {
+        "resolution": f"{width}x{height}",
+        "region": args.region,
+        "scale": args.scale,
+        "quality": quality,
+        "scene": scene,
+        "fps_limit": args.fps,
+        "duration_s": round(elapsed, 2),
+        "frames": frames,
+        "fps": round(frames / elapsed, 2),
+        "bytes_per_frame": round(received / max(frames, 1)),
+        "kbps": round(received / elapsed / 1024, 1),
+        "latency_ms": latency,
+        "cpu_percent": round(cpu / elapsed * 100, 1),
+        "input_events": input_events,
+        "stages": stages,
+        "stage_latency_ms": stage_latency,
+    }
+
+
+def parse_size(value):
+    width, height = (int(v) for v in value.lower().split("x"))
+    return width, height
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark remote desktop lewat loopback")
+    parser.add_argument("--resolutions", nargs="+", default=RESOLUTIONS, help="mis. 1280x720 1920x1080")
+    parser.add_argument("--qualities", nargs="+", type=int, default=QUALITIES)
+    parser.add_argument("--scenes", nargs="+", choices=SCENES, default=SCENES)
+    parser.add_argument("--scale", type=float, default=server.SCREEN_SCALE, help="SCREEN_SCALE server")
+    parser.add_argument("--fps", type=int, default=server.FPS_LIMIT, help="FPS_LIMIT server")
+    parser.add_argument("--jpeg-only", dest="content_aware", action="store_false",
+                        help="matikan pemilihan kodek per tile (semua JPEG)")
+    parser.add_argument("--no-scroll", dest="scroll", action="store_false",
+                        help="matikan deteksi scroll (tanpa instruksi COPY)")
+    parser.add_argument("--cache-entries", type=int, default=server.TILE_CACHE_ENTRIES,
+                        help="kapasitas cache tile, 0 = matikan")
+    parser.add_argument("--motion-codec", choices=sorted(server.MOTION_CODECS) + ["jpeg"], default=server.MOTION_CODEC,
+                        help="kodek tile yang terus berubah; jpeg = tanpa kodek temporal")
+    parser.add_argument("--region", type=int, nargs=4, metavar=("X", "Y", "W", "H"),
+                        help="zoom: region layar yang diminta client lewat VIEWPORT")
+    parser.add_argument("--window", type=parse_size, help="ukuran jendela client, default sama dengan frame")
+    parser.add_argument("--input-rate", type=float, default=60.0,
+                        help="event input sintetis per detik dari client, 0 = tanpa input")
+    parser.add_argument("--duration", type=float, default=5.0, help="detik pengukuran per kasus")
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--output", help="tulis JSON ke file ini selain ke stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    # Handler server.py terikat ke sys.stdout sejak import, jadi tidak ikut
+    # redirect_stdout di bawah; log dipindah ke stderr agar stdout hanya JSON
+    for handler in logging.getLogger().handlers:
+        if type(handler) is logging.StreamHandler and handler.stream is sys.stdout:
+            handler.setStream(sys.stderr)
+    install_probes()
+
+    results = []
+    # Cetakan dari server/client dialihkan ke stderr agar stdout hanya berisi JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        for resolution in args.resolutions:
+            width, height = parse_size(resolution)
+            for quality in args.qualities:
+                for scene in args.scenes:
+                    result = run_case(width, height, quality, scene, args)
+                    results.append(result)
+                    print(
+                        f"{result['resolution']} q{quality} {scene}: {result['fps']} FPS, "
+                        f"{result['bytes_per_frame']} B/frame, "
+                        f"latensi p50 {result['latency_ms']['p50']} ms p99 {result['latency_ms']['p99']} ms",
+                        file=sys.stderr)
+
+    report = {
+        "config": {
+            "delta_mode": server.DELTA_MODE,
+            "tile_size": server.TILE_SIZE,
+            "encode_workers": server.ENCODE_WORKERS,
+            "decode_workers": client.DECODE_WORKERS,
+            "content_aware": args.content_aware,
+            "scroll_detection": args.scroll,
+            "tile_cache_entries": args.cache_entries,
+            "motion_codec": args.motion_codec,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import time
+
+import numpy as np
+
+# Backend capture layar. Setiap backend mengembalikan array RGB (tinggi, lebar, 3)
+# dari dua buffer yang dipakai bergantian, sehingga frame sebelumnya tetap
+# utuh untuk perbandingan delta sampai grab() berikutnya lagi. cursor()
+# mengembalikan posisi kursor (x, y) atau None bila backend tidak bisa membacanya.
+
+
+class DoubleBuffer:
+    def __init__(self, width, height):
+        self.buffers = [np.zeros((height, width, 3), dtype=np.uint8) for _ in range(2)]
+        self.index = 0
+
+    def next(self):
+        self.index ^= 1
+        return self.buffers[self.index]
+
+
+class PyAutoGuiCapture:
+    name = "pyautogui"
+
+    def __init__(self):
+        import pyautogui
+        self.pyautogui = pyautogui
+        self.width, self.height = pyautogui.size()
+
+    def size(self):
+        return self.width, self.height
+
+    def grab(self):
+        return np.asarray(self.pyautogui.screenshot().convert("RGB"))
+
+    def cursor(self):
+        x, y = self.pyautogui.position()
+        return x, y
+
+    def close(self):
+        pass
+
+
+class MssCapture:
+    # Grabber cepat berbasis mss (XShm/GDI/CoreGraphics); data mentah BGRA
+    # disalin sekali ke buffer RGB yang dipakai ulang
+    name = "mss"
+
+    def __init__(self, monitor=1):
+        import mss
+        self.sct = mss.mss()
+        self.monitor = self.sct.monitors[monitor]
+        self.width = self.monitor["width"]
+        self.height = self.monitor["height"]
+        self.frames = DoubleBuffer(self.width, self.height)
+
+    def size(self):
+        return self.width, self.height
+
+    def grab(self):
+        shot = self.sct.grab(self.monitor)
+        bgra = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+        frame = self.frames.next()
+        np.copyto(frame, bgra[:, :, 2::-1])
+        return frame
+
+    def cursor(self):
+        # mss tidak menyediakan posisi kursor; server memakai pynput sebagai gantinya
+        return None
+
+    def close(self):
+        self.sct.close()
+
+
+class SyntheticCapture:
+    # Sumber layar deterministik tanpa display, untuk benchmark dan CI.
+    # Skenario: "desktop" (statis dengan kursor berkedip), "text" (teks
+    # bergulir seperti log/editor), "video" (area bergerak tiap frame) dan
+    # "alttab" (berganti di antara tiga jendela penuh setiap SWITCH_FRAMES).
+    name = "synthetic"
+    scenes = ("desktop", "text", "video", "alttab")
+
+    LINE_HEIGHT = 16
+    SWITCH_FRAMES = 10
+
+    def __init__(self, width=1920, height=1080, scene="desktop", seed=0):
+        if scene not in self.scenes:
+            raise ValueError(f"Skenario sintetis tidak dikenal: {scene}")
+        self.width = width
+        self.height = height
+        self.scene = scene
+        self.frame_index = 0
+        self.rng = np.random.RandomState(seed)
+        self.frames = DoubleBuffer(width, height)
+        self.desktop = self.make_desktop()
+        if scene == "text":
+            self.text = self.make_text(height * 4)
+        if scene == "alttab":
+            self.windows = [self.desktop, self.make_text(height), self.make_photo()]
+
+    def size(self):
+        return self.width, self.height
+
+    def make_desktop(self):
+        desktop = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        gradient = np.linspace(40, 120, self.height, dtype=np.uint8)
+        desktop[:, :, 0] = 20
+        desktop[:, :, 1] = gradient[:, None] // 2
+        desktop[:, :, 2] = gradient[:, None]
+
+        # Beberapa "jendela" dengan title bar
+        for _ in range(4):
+            w = self.rng.randint(self.width // 5, self.width // 2)
+            h = self.rng.randint(self.height // 5, self.height // 2)
+            x = self.rng.randint(0, self.width - w)
+            y = self.rng.randint(0, self.height - h)
+            desktop[y:y + h, x:x + w] = 235
+            desktop[y:y + 24, x:x + w] = (60, 90, 160)
+        return desktop
+
+    def make_text(self, height):
+        # Baris teks dari "glyph" 6x10 acak di atas latar editor gelap
+        text = np.full((height, self.width, 3), 30, dtype=np.uint8)
+        glyphs = self.rng.rand(64, 10, 6) > 0.55
+        for top in range(0, height - self.LINE_HEIGHT, self.LINE_HEIGHT):
+            length = self.rng.randint(0, self.width // 8)
+            codes = self.rng.randint(0, len(glyphs), length)
+            codes[self.rng.rand(length) < 0.15] = -1  # spasi
+            for column, code in enumerate(codes):
+                if code < 0:
+                    continue
+                x = 8 + column * 7
+                block = text[top + 3:top + 13, x:x + 6]
+                block[glyphs[code][:, :block.shape[1]]] = (200, 200, 190)
+        return text
+
+    def make_photo(self):
+        xs = np.arange(self.width, dtype=np.float32)[None, :]
+        ys = np.arange(self.height, dtype=np.float32)[:, None]
+        photo = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        photo[:, :, 0] = 127 + 127 * np.sin(xs / 41) * np.cos(ys / 29)
+        photo[:, :, 1] = 127 + 127 * np.sin((xs + ys) / 53)
+        photo[:, :, 2] = 127 + 127 * np.cos(xs / 67 - ys / 37)
+        return photo
+
+    def grab(self):
+        frame = self.frames.next()
+        index = self.frame_index
+        self.frame_index += 1
+
+        if self.scene == "text":
+            # Bergulir satu baris per frame, berputar di akhir konten
+            offset = (index * self.LINE_HEIGHT) % len(self.text)
+            first = min(self.height, len(self.text) - offset)
+            frame[:first] = self.text[offset:offset + first]
+            frame[first:] = self.text[:self.height - first]
+            return frame
+
+        if self.scene == "alttab":
+            np.copyto(frame, self.windows[(index // self.SWITCH_FRAMES) % len(self.windows)])
+        else:
+            np.copyto(frame, self.desktop)
+
+        if self.scene == "video":
+            w, h = self.width * 2 // 5, self.height * 2 // 5
+            x, y = self.width // 4, self.height // 4
+            xs = np.arange(w, dtype=np.float32)[None, :]
+            ys = np.arange(h, dtype=np.float32)[:, None]
+            phase = index * 0.3
+            frame[y:y + h, x:x + w, 0] = (127 + 127 * np.sin(xs / 23 + phase)).astype(np.uint8)
+            frame[y:y + h, x:x + w, 1] = (127 + 127 * np.sin(ys / 17 - phase)).astype(np.uint8)
+            frame[y:y + h, x:x + w, 2] = (127 + 127 * np.sin((xs + ys) / 31 + phase * 0.7)).astype(np.uint8)
+
+        # Kursor teks berkedip dua kali per detik pada 20 FPS
+        if (index // 10) % 2 == 0:
+            frame[self.height // 2:self.height // 2 + 18, self.width // 3:self.width // 3 + 2] = 0
+        return frame
+
+    def cursor(self):
+        # Kursor bergerak sepanjang kurva Lissajous agar kanal kursor punya data
+        t = time.monotonic()
+        x = self.width / 2 + self.width / 3 * np.sin(t * 0.7)
+        y = self.height / 2 + self.height / 3 * np.sin(t * 1.1)
+        return int(x), int(y)
+
+    def close(self):
+        pass
+
+
+CAPTURE_BACKENDS = {
+    PyAutoGuiCapture.name: PyAutoGuiCapture,
+    MssCapture.name: MssCapture,
+    SyntheticCapture.name: SyntheticCapture,
+}
+
+
+def create_capture(name, **options):
+    if name not in CAPTURE_BACKENDS:
+        raise ValueError(f"Backend capture tidak dikenal: {name}")
+    return CAPTURE_BACKENDS[name](**options)
@@ -1,11 +1,18 @@
 import socket
-import struct
 import cv2
 import numpy as np
 import pygame
 import time
 import threading
 import queue
+import os
+import zlib
+import json
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import protocol
+import metrics
 
 # Konfigurasi client
 SERVER_IP = "172.16.1.4"  # Ganti dengan IP server
@@ -15,66 +22,695 @@ WINDOW_WIDTH = 1024
 WINDOW_HEIGHT = 768  
 FULLSCREEN = False   
 ADAPTIVE_QUALITY = True  
+DECODE_WORKERS = os.cpu_count() or 1
+STATS_INTERVAL = 1.0  # laporan FPS/bandwidth ke server untuk kualitas adaptif
+CLOCK_INTERVAL = 2.0  # PING untuk estimasi selisih jam dengan server (FRAME_V2)
+REDUCED_DECODE = True  # decode JPEG langsung ke 1/2, 1/4 atau 1/8 bila jendela lebih kecil
+DISPLAY_REFRESH_RATE = 60  # dipakai bila refresh rate monitor tidak bisa dibaca
+SHOW_BREAKDOWN = False  # rincian waktu per tahap di overlay, bisa diubah dengan F10
+REMOTE_CURSOR = True  # gambar kursor server dari pesan FRAME_CURSOR, bukan menunggu frame
+TILE_CACHE_ENTRIES = 4096  # tile terenkode yang disimpan untuk dirujuk server, 0 = matikan
+MOTION_CODEC = True  # CAPS MOTION: video/animasi dikirim server sebagai residual antar frame
+ZOOM_FACTOR = 2  # F9: tampilkan 1/ZOOM_FACTOR layar server di sekitar pointer
+# F8: isi clipboard lokal diketik di server sebagai satu perintah TYPE_TEXT
+RECONNECT_DELAY = 0.5       # jeda awal sambung ulang, digandakan tiap percobaan gagal
+RECONNECT_MAX_DELAY = 10.0
+SILENCE_TIMEOUT = 6.0  # sambung ulang bila server diam selama ini (heartbeat FRAME_V2 tiap 2 detik)
 
 connected = False
 running = True
 server_width = 0
 server_height = 0
+server_capabilities = set()
+# Region layar server (x, y, w, h) yang ditampilkan, None = seluruh layar.
+# Dengan VIEWPORT server meng-encode region ini seukuran jendela.
+viewport_region = None
+
+# Framebuffer (BGR) milik thread decode; thread scale membacanya di bawah frame_lock.
+# framebuffer_size adalah ukuran frame server, framebuffer bisa lebih kecil
+# sebesar framebuffer_scale bila di-decode dengan ukuran diperkecil.
+framebuffer = None
+framebuffer_size = (0, 0)
+framebuffer_scale = 1
+framebuffer_captured = 0  # waktu capture (jam server, mikrodetik) dari isi framebuffer
+frame_version = 0
+frame_lock = threading.Lock()
+frame_changed = threading.Condition(frame_lock)
 
-frame_queue = queue.Queue(maxsize=3)
 message_queue = queue.Queue()
+decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="decode")
 status_message = "Menghubungkan ke server..."
 
-frame_times = []
-bandwidth_usage = []
+# Waktu tiap tahap client (ms) dan statistik tahap server terakhir dari pesan RDST
+CLIENT_STAGES = ("recv", "queue", "decode", "scale", "present", "e2e")
+stage_timings = metrics.StageTimings(CLIENT_STAGES)
+server_stats = {}
+frames_dropped = 0  # celah nomor urut dari server + frame yang dilewati tahap decode
+tile_cache = None  # protocol.TileCache berisi (encoding, data) bila server mendukung TILECACHE
+# Referensi kodek temporal (BGR, resolusi penuh frame server); hanya dipakai
+# thread decode. Tidak pernah dikosongkan: setelah reset kodek server hanya
+# mengirim rect INTRA untuk tile yang belum diisi ulang, jadi isi lama tidak terbaca.
+motion_reference = None
+
+# Sesi untuk resume setelah koneksi putus: token dari FRAME_SESSION dan seq
+# frame terakhir yang sudah diterapkan ke framebuffer (dan cache tile)
+session_token = None
+applied_seq = -1
+
+# Posisi kursor server (koordinat layar server) dari FRAME_CURSOR; cursor_version
+# naik setiap ada perubahan agar thread utama tahu kapan harus menggambar ulang
+cursor_position = None
+cursor_version = 0
+
+frame_rate = metrics.RateMeter()
 current_fps = 0
 current_bandwidth = 0
+current_input_latency = 0
 
-def send_command(sock, command):
-    try:
-        message = command + "\n"
-        sock.sendall(message.encode())
-    except:
-        pass
-
-def recv_all(sock, n):
-    data = b""
-    while len(data) < n:
-        packet = sock.recv(min(4096, n - len(data)))
-        if not packet:
+def encode_command(command, binary):
+    cmd_type, args = command[0], command[1:]
+    if binary and cmd_type in protocol.INPUT_CODES:
+        if not cmd_type.startswith("KEY_"):
+            return protocol.pack_input(cmd_type, *args)
+        code = protocol.encode_key(args[0])
+        if code is not None:
+            return protocol.pack_input(cmd_type, code)
+    # Fallback ke protokol teks untuk server lama atau tombol yang tidak dikenal
+    return (" ".join(str(part) for part in command) + "\n").encode()
+
+def send_commands(sock, commands):
+    binary = protocol.CAP_BINARY_INPUT in server_capabilities
+    sock.sendall(b"".join(encode_command(command, binary) for command in commands))
+
+def queue_command(*command):
+    message_queue.put((time.perf_counter(), command))
+
+def sender_thread(sock):
+    # Input dikirim begitu pygame menghasilkannya, tidak menunggu frame selesai diterima
+    global connected, status_message, current_input_latency
+    
+    while connected and running:
+        items = [message_queue.get()]
+        while True:
+            try:
+                items.append(message_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        # None hanya membangunkan thread saat koneksi ditutup
+        items = [item for item in items if item is not None]
+        
+        if items:
+            commands = protocol.coalesce_moves([command for _, command in items])
+            try:
+                send_commands(sock, commands)
+            except OSError as e:
+                if connected:
+                    status_message = f"Error jaringan: {str(e)}"
+                    print(f"Send error: {e}")
+                connected = False
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                break
+            
+            latency = (time.perf_counter() - items[0][0]) * 1000
+            current_input_latency = 0.8 * current_input_latency + 0.2 * latency
+
+class FrameReceiver:
+    # Membaca pesan langsung ke buffer yang dipakai ulang dengan recv_into,
+    # tanpa menyambung potongan bytes untuk setiap paket. Buffer dipinjamkan
+    # ke tahap decode dan kembali ke pool lewat release(). Dengan kanal,
+    # pesan disusun ulang per kanal dari chunk yang berselang-seling.
+    INCOMPLETE = object()
+    
+    def __init__(self, sock, pending=b""):
+        self.sock = sock
+        self.pending = bytearray(pending)
+        self.header = bytearray(protocol.FRAME_HEADER.size)
+        self.chunk_header = bytearray(protocol.CHUNK_HEADER.size)
+        self.assembling = {}  # kanal -> [buffer, terisi, header, mulai]
+        self.free = deque()
+        self.received = time.time()  # waktu data terakhir tiba dari socket
+    
+    def read_into(self, view):
+        filled = 0
+        if self.pending:
+            filled = min(len(view), len(self.pending))
+            view[:filled] = self.pending[:filled]
+            del self.pending[:filled]
+        
+        while filled < len(view):
+            try:
+                count = self.sock.recv_into(view[filled:])
+            except socket.timeout:
+                # Timeout hanya boleh terjadi di batas pesan agar stream tetap sinkron
+                if filled == 0 or not running:
+                    raise
+                if time.time() - self.received > SILENCE_TIMEOUT:
+                    raise ConnectionError("tidak ada data dari server di tengah pesan")
+                continue
+            if not count:
+                return False
+            self.received = time.time()
+            filled += count
+        return True
+    
+    def acquire(self, size):
+        try:
+            buffer = self.free.pop()
+        except IndexError:
+            buffer = bytearray(1 << 20)
+        if size > len(buffer):
+            buffer = bytearray(max(size, 2 * len(buffer)))
+        return buffer
+    
+    def release(self, buffer):
+        self.free.append(buffer)
+    
+    def read_header(self, prefix=0):
+        # Header lama 16 byte dibaca dulu; bila diawali FRAME_MAGIC sisanya
+        # dibaca sesuai header_size, termasuk field tambahan versi berikutnya.
+        # prefix = jumlah byte awal yang sudah ada di self.header
+        legacy_size = protocol.LEGACY_HEADER.size
+        if not self.read_into(memoryview(self.header)[prefix:legacy_size]):
+            return None
+        if self.header[:4] == protocol.FRAME_MAGIC:
+            header_size = self.header[5]
+            if header_size < protocol.FRAME_HEADER.size:
+                raise ValueError(f"Header frame terlalu pendek: {header_size} byte")
+            if header_size > len(self.header):
+                self.header.extend(bytes(header_size - len(self.header)))
+            if not self.read_into(memoryview(self.header)[legacy_size:header_size]):
+                return None
+        return protocol.unpack_header(self.header)
+    
+    def read_message(self):
+        # Hasil berupa (buffer, memoryview, w, h, FrameInfo atau None untuk
+        # header lama); payload valid sampai buffer di-release
+        magic_size = len(protocol.CHUNK_MAGIC)
+        while True:
+            if not self.read_into(memoryview(self.header)[:magic_size]):
+                return None
+            if self.header[:magic_size] != protocol.CHUNK_MAGIC:
+                return self.read_frame(magic_size)
+            message = self.read_chunk()
+            if message is not self.INCOMPLETE:
+                return message
+    
+    def read_chunk(self):
+        # Pesan dikembalikan bila chunk ini menutupnya, INCOMPLETE bila belum
+        magic_size = len(protocol.CHUNK_MAGIC)
+        if not self.read_into(memoryview(self.chunk_header)[magic_size:]):
+            return None
+        _, channel, flags, length = protocol.CHUNK_HEADER.unpack_from(self.chunk_header)
+        
+        if channel not in self.assembling:
+            # Chunk pertama sebuah pesan selalu memuat header frame lengkap
+            header = self.read_header()
+            if header is None:
+                return None
+            length -= self.header[5]
+            self.assembling[channel] = [self.acquire(header[0]), 0, header, time.perf_counter()]
+        
+        assembly = self.assembling[channel]
+        buffer, filled, header, start = assembly
+        data_len, width, height, info = header
+        if length < 0 or filled + length > data_len:
+            raise ValueError(f"Chunk kanal {channel} melebihi panjang pesan")
+        if not self.read_into(memoryview(buffer)[filled:filled + length]):
+            return None
+        assembly[1] = filled + length
+        if not flags & protocol.CHUNK_END:
+            return self.INCOMPLETE
+        
+        del self.assembling[channel]
+        if assembly[1] != data_len:
+            raise ValueError(f"Pesan kanal {channel} terpotong")
+        # Termasuk waktu menunggu chunk kanal lain yang diselipkan
+        stage_timings.record("recv", time.perf_counter() - start)
+        return buffer, memoryview(buffer)[:data_len], width, height, info
+    
+    def read_frame(self, prefix):
+        header = self.read_header(prefix)
+        if header is None:
+            return None
+        data_len, width, height, info = header
+        
+        buffer = self.acquire(data_len)
+        payload = memoryview(buffer)[:data_len]
+        
+        # Waktu recv dihitung setelah header tiba, tanpa waktu menunggu frame
+        start = time.perf_counter()
+        if not self.read_into(payload):
+            self.release(buffer)
             return None
-        data += packet
-    return data
+        stage_timings.record("recv", time.perf_counter() - start)
+        return buffer, payload, width, height, info
 
-def update_performance_metrics(frame_size):
-    global frame_times, bandwidth_usage, current_fps, current_bandwidth
+def now_us():
+    return time.monotonic_ns() // 1000
+
+class ClockSync:
+    # Selisih jam server terhadap client dari balasan PING (FRAME_CLOCK).
+    # Dari beberapa sampel terakhir dipakai yang RTT-nya terkecil karena
+    # paling sedikit terganggu antrian.
+    def __init__(self, samples=8):
+        self.samples = deque(maxlen=samples)
+        self.offset = None
     
-    current_time = time.time()
-    frame_times.append(current_time)
+    def request(self):
+        queue_command("PING", now_us())
     
-    if len(frame_times) > 100:
-        frame_times.pop(0)
+    def on_reply(self, payload):
+        sent, server_time = protocol.CLOCK_PAYLOAD.unpack(payload)
+        received = now_us()
+        self.samples.append((received - sent, server_time - (sent + received) // 2))
+        self.offset = min(self.samples)[1]
     
-    if len(frame_times) > 1:
-        current_fps = 1.0 / (frame_times[-1] - frame_times[-2])
+    def to_local(self, server_time):
+        return server_time - self.offset
+
+clock_sync = ClockSync()
+
+def update_performance_metrics(frame_size=None):
+    global current_fps, current_bandwidth
     
-    bandwidth_usage.append((current_time, frame_size))
+    if frame_size is not None:
+        frame_rate.add(frame_size)
+    fps, bytes_per_second = frame_rate.rates()
+    current_fps = fps
+    current_bandwidth = bytes_per_second / 1024  # KB/s
+
+REDUCED_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+def reduced(length, scale):
+    # Ukuran hasil decode JPEG yang diperkecil selalu dibulatkan ke atas
+    return -(-length // scale)
+
+def decode_scale(width, height):
+    # Faktor terbesar yang hasilnya masih tidak lebih kecil dari jendela
+    if REDUCED_DECODE:
+        for scale in (8, 4, 2):
+            if width // scale >= WINDOW_WIDTH and height // scale >= WINDOW_HEIGHT:
+                return scale
+    return 1
+
+def decode_image(data, scale=1):
+    # Decode langsung dari buffer penerima; hasil tetap BGR karena
+    # permukaan pygame dibuat dengan format "BGR"
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), REDUCED_FLAGS[scale])
+
+def decode_palette(data, width, height, scale=1):
+    raw = zlib.decompress(data)
+    count, = protocol.PALETTE_HEADER.unpack_from(raw)
+    offset = protocol.PALETTE_HEADER.size
+    # Palet dikirim RGB, framebuffer client BGR
+    palette = np.frombuffer(raw, dtype=np.uint8, count=count * 3, offset=offset).reshape(count, 3)[:, ::-1]
+    indices = np.frombuffer(raw, dtype=np.uint8, count=width * height, offset=offset + count * 3)
+    tile = palette[indices.reshape(height, width)]
+    if scale > 1:
+        tile = cv2.resize(tile, (reduced(width, scale), reduced(height, scale)), interpolation=cv2.INTER_AREA)
+    return tile
+
+def decode_rect(rect, scale=1):
+    x, y, w, h, encoding, data = rect
+    if encoding == protocol.ENC_PALETTE:
+        return decode_palette(data, w, h, scale)
+    return decode_image(data, scale)
+
+def decode_motion(rect, width, height, scale=1):
+    # Harus dipanggil untuk setiap rect MOTION sesuai urutan. Referensi tetap
+    # resolusi penuh walau framebuffer di-decode diperkecil. Residual dihitung
+    # server per kanal, jadi bisa langsung diterapkan pada referensi BGR.
+    global motion_reference
+    x, y, w, h, _, data = rect
+    if motion_reference is None or motion_reference.shape[:2] != (height, width):
+        motion_reference = np.zeros((height, width, 3), dtype=np.uint8)
+    mode, vectors, indices, image = protocol.unpack_motion(data, w, h)
+    tile = decode_image(image)
+    if tile is None or tile.shape[:2] != (h, w):
+        return None
+    if mode == protocol.MOTION_INTER:
+        padded = protocol.pad_reference(motion_reference, (x, y, w, h))
+        tile = protocol.apply_residual(protocol.predict_motion(padded, w, h, vectors, indices), tile)
+    motion_reference[y:y + h, x:x + w] = tile
+    if scale > 1:
+        tile = cv2.resize(tile, (reduced(w, scale), reduced(h, scale)), interpolation=cv2.INTER_AREA)
+    return tile
+
+DECODERS = (protocol.ENC_JPEG, protocol.ENC_PALETTE)
+
+def resolve_cached(rects):
+    # Simpan tile berkunci dan ganti rujukan dengan isi cache. Harus dipanggil
+    # untuk setiap paket sesuai urutan, termasuk yang tidak ditampilkan, agar
+    # urutan LRU sama dengan cermin di server.
+    resolved = []
+    for x, y, w, h, encoding, data in rects:
+        if encoding & protocol.CACHE_STORE:
+            key, data = bytes(data[:protocol.CACHE_KEY_SIZE]), bytes(data[protocol.CACHE_KEY_SIZE:])
+            encoding &= ~protocol.CACHE_STORE
+            tile_cache.put(key, (encoding, data))
+        elif encoding == protocol.ENC_CACHE:
+            cached = tile_cache.get(bytes(data))
+            if cached is None:
+                continue
+            encoding, data = cached
+        resolved.append((x, y, w, h, encoding, data))
+    return resolved
+
+def store_frame(frame, width, height, scale, captured=0):
+    global framebuffer, framebuffer_size, framebuffer_scale, framebuffer_captured, frame_version
+    with frame_changed:
+        framebuffer = frame
+        framebuffer_size = (width, height)
+        framebuffer_scale = scale
+        framebuffer_captured = captured
+        frame_version += 1
+        frame_changed.notify_all()
+
+def apply_rects(width, height, rects, scale, captured=0):
+    global framebuffer, framebuffer_size, framebuffer_scale, framebuffer_captured, frame_version
     
-    while bandwidth_usage and current_time - bandwidth_usage[0][0] > 5.0:
-        bandwidth_usage.pop(0)
+    if tile_cache is not None:
+        rects = resolve_cached(rects)
+    rects = [rect for rect in rects if rect[4] in DECODERS or rect[4] in (protocol.ENC_COPY, protocol.ENC_MOTION)]
+    encoded = [rect for rect in rects if rect[4] in DECODERS]
     
-    if len(bandwidth_usage) > 1:
-        total_bytes = sum(size for _, size in bandwidth_usage)
-        time_span = bandwidth_usage[-1][0] - bandwidth_usage[0][0]
-        if time_span > 0:
-            current_bandwidth = total_bytes / time_span / 1024  # KB/s
+    # Stripe dan tile di-decode paralel; cv2.imdecode dan zlib melepas GIL
+    if len(encoded) > 1 and DECODE_WORKERS > 1:
+        images = decode_pool.map(decode_rect, encoded, [scale] * len(encoded))
+    else:
+        images = [decode_rect(rect, scale) for rect in encoded]
+    images = iter(images)
+    # Rect MOTION saling bergantung lewat referensi, jadi di-decode berurutan
+    # di thread ini sementara pool men-decode tile lainnya
+    moving = iter([decode_motion(rect, width, height, scale) for rect in rects if rect[4] == protocol.ENC_MOTION])
+    
+    shape = (reduced(height, scale), reduced(width, scale), 3)
+    with frame_changed:
+        if framebuffer is None or framebuffer_size != (width, height):
+            framebuffer = np.zeros(shape, dtype=np.uint8)
+        elif framebuffer.shape != shape:
+            # Faktor decode berubah karena jendela di-resize; isi lama diskalakan
+            # dan tertimpa tile baru seiring perubahan layar
+            framebuffer = cv2.resize(framebuffer, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+        framebuffer_size = (width, height)
+        framebuffer_scale = scale
+        framebuffer_captured = captured
+        
+        # Posisi tile kelipatan TILE_SIZE sehingga habis dibagi faktor decode.
+        # COPY membaca framebuffer saat itu, jadi urutan dari server dijaga;
+        # pada decode diperkecil posisinya dibulatkan ke bawah.
+        for x, y, w, h, encoding, data in rects:
+            if encoding == protocol.ENC_COPY:
+                sx, sy = (value // scale for value in protocol.COPY_SOURCE.unpack(data))
+                x, y = x // scale, y // scale
+                h = min(reduced(h, scale), shape[0] - max(y, sy))
+                w = min(reduced(w, scale), shape[1] - max(x, sx))
+                if w > 0 and h > 0:
+                    framebuffer[y:y + h, x:x + w] = framebuffer[sy:sy + h, sx:sx + w]
+                continue
+            tile = next(moving) if encoding == protocol.ENC_MOTION else next(images)
+            if tile is not None and tile.shape[:2] == (reduced(h, scale), reduced(w, scale)):
+                x, y = x // scale, y // scale
+                framebuffer[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+        frame_version += 1
+        frame_changed.notify_all()
+
+def is_keyframe(payload, width, height, info=None):
+    if info is not None:
+        return bool(info.flags & protocol.FLAG_KEYFRAME)
+    if not protocol.is_rect_packet(payload):
+        return True
+    return protocol.covers_frame(protocol.unpack_rects(payload), width, height)
+
+class DecodeStage:
+    # Thread decode di antara penerima dan framebuffer. Delta harus diterapkan
+    # berurutan, tetapi semua pesan sebelum keyframe terakhir yang menunggu
+    # boleh dibuang karena isinya tertimpa seluruhnya.
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.pending = deque()
+        self.cond = threading.Condition()
+        self.skipped = 0
+    
+    def submit(self, buffer, payload, width, height, info=None):
+        with self.cond:
+            self.pending.append((buffer, payload, width, height, info, time.perf_counter()))
+            self.cond.notify()
+    
+    def take(self):
+        with self.cond:
+            while not self.pending and connected and running:
+                self.cond.wait(0.5)
+            batch = list(self.pending)
+            self.pending.clear()
+        
+        start = 0
+        for index, (_, payload, width, height, info, _) in enumerate(batch):
+            if index > start and is_keyframe(payload, width, height, info):
+                start = index
+        for buffer, payload, width, height, _, _ in batch[:start]:
+            if protocol.is_rect_packet(payload):
+                rects = protocol.unpack_rects(payload)
+                if tile_cache is not None:
+                    resolve_cached(rects)
+                # Keyframe dari antrean server yang digabung tidak selalu titik
+                # reset kodek temporal, jadi rect MOTION tetap mengisi referensi
+                for rect in rects:
+                    if rect[4] == protocol.ENC_MOTION:
+                        decode_motion(rect, width, height)
+            payload.release()
+            self.receiver.release(buffer)
+        self.skipped += start
+        return batch[start:]
+    
+    def decode(self, payload, width, height, info=None):
+        scale = decode_scale(width, height)
+        captured = info.captured if info is not None else 0
+        if protocol.is_rect_packet(payload):
+            apply_rects(width, height, protocol.unpack_rects(payload), scale, captured)
+        else:
+            frame = decode_image(payload, scale)
+            if frame is not None:
+                store_frame(frame, width, height, scale, captured)
+    
+    def run(self):
+        global applied_seq
+        while connected and running:
+            for buffer, payload, width, height, info, queued in self.take():
+                try:
+                    started = time.perf_counter()
+                    stage_timings.record("queue", started - queued)
+                    self.decode(payload, width, height, info)
+                    stage_timings.record("decode", time.perf_counter() - started)
+                    if info is not None:
+                        applied_seq = info.seq
+                except Exception as e:
+                    print(f"Decode error: {e}")
+                finally:
+                    payload.release()
+                    self.receiver.release(buffer)
+    
+    def close(self):
+        with self.cond:
+            self.cond.notify_all()
+
+class ScaleStage:
+    # Menskalakan framebuffer ke ukuran jendela di thread sendiri. Tiga buffer
+    # bergilir: satu sedang ditampilkan, satu siap ditampilkan, satu ditulis;
+    # frame yang siap tetapi belum ditampilkan langsung diganti yang lebih baru.
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.size = (WINDOW_WIDTH, WINDOW_HEIGHT)
+        self.buffers = [None, None, None]
+        self.captured = [0, 0, 0]
+        self.ready = None
+        self.presenting = None
+        self.version = -1
+    
+    def resize(self, width, height):
+        with self.cond:
+            self.size = (width, height)
+            self.ready = None
+        with frame_changed:
+            self.version = -1
+            frame_changed.notify_all()
+    
+    def take(self):
+        # (buffer, waktu capture isinya) atau None bila belum ada frame baru
+        with self.cond:
+            if self.ready is None:
+                return None
+            self.presenting, self.ready = self.ready, None
+            return self.buffers[self.presenting], self.captured[self.presenting]
+    
+    def run(self):
+        while running:
+            with frame_changed:
+                while running and (framebuffer is None or frame_version == self.version):
+                    frame_changed.wait(0.5)
+                if not running:
+                    break
+            
+            with self.cond:
+                width, height = self.size
+                index = next(i for i in range(3) if i not in (self.ready, self.presenting))
+                target = self.buffers[index]
+                if target is None or target.shape[:2] != (height, width):
+                    target = self.buffers[index] = np.zeros((height, width, 3), dtype=np.uint8)
+            
+            with frame_changed, stage_timings.measure("scale"):
+                self.version = frame_version
+                self.captured[index] = framebuffer_captured
+                if framebuffer.shape == target.shape:
+                    np.copyto(target, framebuffer)
+                else:
+                    interpolation = cv2.INTER_AREA if framebuffer.shape[1] > width else cv2.INTER_LINEAR
+                    cv2.resize(framebuffer, (width, height), dst=target, interpolation=interpolation)
+            
+            with self.cond:
+                # Ukuran jendela bisa berubah selama resize berlangsung
+                if self.size == (width, height):
+                    self.ready = index
+
+scale_stage = ScaleStage()
+
+def display_refresh_rate():
+    # pygame-ce menyediakan refresh rate monitor; pygame biasa memakai nilai konfigurasi
+    get_rates = getattr(pygame.display, "get_desktop_refresh_rates", None)
+    if get_rates is not None:
+        try:
+            rates = [rate for rate in get_rates() if rate > 0]
+            if rates:
+                return rates[0]
+        except pygame.error:
+            pass
+    return DISPLAY_REFRESH_RATE
+
+def overlay_lines():
+    lines = [
+        f"FPS: {current_fps:.1f}",
+        f"Bandwidth: {current_bandwidth:.1f} KB/s",
+        f"Resolution: {server_width}x{server_height}",
+        f"Input: {current_input_latency:.1f} ms",
+    ]
+    e2e = stage_timings.summary().get("e2e")
+    if e2e is not None:
+        lines.append(f"Latency: {e2e['p50']:.1f} ms (p99 {e2e['p99']:.1f})")
+    if protocol.CAP_FRAME_HEADER in server_capabilities:
+        lines.append(f"Dropped: {frames_dropped}")
+    if tile_cache is not None:
+        lines.append(f"Tile cache: {len(tile_cache)} tiles, {tile_cache.hits} hits, {tile_cache.misses} misses")
+    if SHOW_BREAKDOWN:
+        # p50/p99 per tahap: server dulu, lalu client sesuai urutan pipeline
+        for side, stages in (("Server", server_stats.get("stages", {})), ("Client", stage_timings.summary())):
+            for stage, stats in stages.items():
+                lines.append(f"{side} {stage}: {stats['p50']:.1f} / {stats['p99']:.1f} ms")
+    return lines
+
+def stats_command():
+    # Client FRAME_V2 ikut melaporkan latensi capture-ke-layar dan frame yang hilang
+    command = ["STATS", f"{current_fps:.1f}", f"{current_bandwidth:.1f}"]
+    if protocol.CAP_FRAME_HEADER in server_capabilities:
+        e2e = stage_timings.summary().get("e2e")
+        command += [f"{e2e['p50']:.1f}" if e2e else "-", frames_dropped]
+    return command
+
+def make_cursor_image():
+    # Panah standar dengan outline hitam; hotspot di ujung kiri atas
+    points = [(0, 0), (0, 16), (4, 12), (7, 18), (9, 17), (6, 11), (11, 11)]
+    image = pygame.Surface((12, 19), pygame.SRCALPHA)
+    pygame.draw.polygon(image, (255, 255, 255), points)
+    pygame.draw.polygon(image, (0, 0, 0), points, 1)
+    return image
+
+def screen_region():
+    return viewport_region or (0, 0, server_width, server_height)
+
+def send_viewport():
+    global viewport_region
+    if protocol.CAP_VIEWPORT in server_capabilities:
+        queue_command("VIEWPORT", WINDOW_WIDTH, WINDOW_HEIGHT, *(viewport_region or ()))
+    else:
+        # Server tanpa VIEWPORT selalu mengirim seluruh layar, jadi kursor dan
+        # mouse juga harus dipetakan ke seluruh layar (mis. setelah reconnect)
+        viewport_region = None
+
+def paste_clipboard():
+    if protocol.CAP_TYPE_TEXT not in server_capabilities:
+        print("Server tidak mendukung TYPE_TEXT, paste diabaikan")
+        return
+    try:
+        if not pygame.scrap.get_init():
+            pygame.scrap.init()
+        data = pygame.scrap.get(pygame.SCRAP_TEXT)
+    except pygame.error as e:
+        print(f"Clipboard tidak tersedia: {e}")
+        return
+    if not data:
+        return
+    text = data.decode("utf-8", errors="ignore").replace("\x00", "").replace("\r\n", "\n")
+    if text:
+        queue_command("TYPE_TEXT", json.dumps(text))
+
+def toggle_zoom(x, y):
+    # Perbesar di sekitar posisi pointer di jendela, atau kembali ke seluruh layar
+    global viewport_region
+    if protocol.CAP_VIEWPORT not in server_capabilities:
+        print("Server tidak mendukung VIEWPORT, zoom diabaikan")
+        return
+    if viewport_region is not None or not server_width or not server_height:
+        viewport_region = None
+    else:
+        width, height = server_width // ZOOM_FACTOR, server_height // ZOOM_FACTOR
+        center_x = x * server_width // WINDOW_WIDTH
+        center_y = y * server_height // WINDOW_HEIGHT
+        left = min(max(0, center_x - width // 2), server_width - width)
+        top = min(max(0, center_y - height // 2), server_height - height)
+        viewport_region = (left, top, width, height)
+    send_viewport()
+
+def draw_cursor(screen, image):
+    left, top, width, height = screen_region()
+    if cursor_position is None or not width or not height:
+        return
+    x, y = cursor_position
+    screen.blit(image, ((x - left) * WINDOW_WIDTH // width, (y - top) * WINDOW_HEIGHT // height))
+
+def reset_tile_cache():
+    # Cache baru per sesi, sama seperti cermin di server
+    global tile_cache
+    tile_cache = None
+    if TILE_CACHE_ENTRIES > 0 and protocol.CAP_TILE_CACHE in server_capabilities:
+        tile_cache = protocol.TileCache(TILE_CACHE_ENTRIES)
+        queue_command("CACHE", TILE_CACHE_ENTRIES)
 
 def network_thread():
-    global connected, server_width, server_height, status_message, running
+    # Satu koneksi sampai putus; True bila koneksi sempat tersambung
+    global connected, server_width, server_height, server_capabilities, status_message, running, server_stats
+    global frames_dropped, cursor_position, cursor_version, session_token, applied_seq
     
     status_message = f"Menghubungkan ke {SERVER_IP}:{PORT}..."
     
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    decoder = None
+    sender = decode_thread = None
+    established = False
+    
+    # Input yang tertahan selama koneksi putus dibuang, bukan diketik belakangan
+    while True:
+        try:
+            message_queue.get_nowait()
+        except queue.Empty:
+            break
     
     try:
         client_socket.settimeout(5.0)
@@ -87,58 +723,145 @@ def network_thread():
             if not chunk:
                 status_message = "Koneksi terputus saat menerima konfigurasi"
                 client_socket.close()
-                return
+                return False
             config_data += chunk
         
-        config_str = config_data.split(b"\n")[0].decode()
+        config_line, _, remaining_data = config_data.partition(b"\n")
+        config_str = config_line.decode()
         if config_str.startswith("CONFIG "):
             parts = config_str.split()
             if len(parts) >= 3:
                 server_width = int(parts[1])
                 server_height = int(parts[2])
+                server_capabilities = set(parts[3:])
                 print(f"Ukuran layar server: {server_width}x{server_height}")
         
-        remaining_data = b"".join(config_data.split(b"\n")[1:])
+        receiver = FrameReceiver(client_socket, remaining_data)
+        decoder = DecodeStage(receiver)
+        
+        # RESUME harus diproses server sebelum CAPS; cache tile lama dipakai
+        # terus sampai FRAME_SESSION memastikan sesi benar-benar dilanjutkan
+        frame_header = protocol.CAP_FRAME_HEADER in server_capabilities
+        resuming = frame_header and session_token is not None and protocol.CAP_RESUME in server_capabilities
+        if resuming:
+            queue_command("RESUME", session_token.hex(), applied_seq)
+        else:
+            session_token = None
+        if frame_header:
+            caps = [protocol.CAP_FRAME_HEADER, protocol.CAP_PALETTE, protocol.CAP_COPY_RECT]
+            if protocol.CAP_RESUME in server_capabilities:
+                caps.append(protocol.CAP_RESUME)
+            if protocol.CAP_CHANNELS in server_capabilities:
+                caps.append(protocol.CAP_CHANNELS)
+            if REMOTE_CURSOR and protocol.CAP_CURSOR in server_capabilities:
+                caps.append(protocol.CAP_CURSOR)
+            if MOTION_CODEC and protocol.CAP_MOTION in server_capabilities:
+                caps.append(protocol.CAP_MOTION)
+            queue_command("CAPS", *caps)
+        if not resuming:
+            reset_tile_cache()
+        send_viewport()
+        last_seq = None
+        seq_gaps = 0
+        last_clock_time = 0
+        last_ack = applied_seq
+        
+        connected = established = True
         
-        connected = True
+        sender = threading.Thread(target=sender_thread, args=(client_socket,), daemon=True)
+        sender.start()
+        decode_thread = threading.Thread(target=decoder.run, daemon=True, name="decode-stage")
+        decode_thread.start()
+        last_stats_time = time.time()
         
         while connected and running:
+            if time.time() - last_stats_time >= STATS_INTERVAL:
+                update_performance_metrics()
+                if ADAPTIVE_QUALITY:
+                    queue_command(*stats_command())
+                if SHOW_BREAKDOWN:
+                    queue_command("METRICS")
+                if session_token is not None and applied_seq != last_ack:
+                    queue_command("ACK", applied_seq)
+                    last_ack = applied_seq
+                last_stats_time = time.time()
+            
+            if frame_header and time.time() - last_clock_time >= CLOCK_INTERVAL:
+                clock_sync.request()
+                last_clock_time = time.time()
+            
             try:
-                while not message_queue.empty():
-                    msg = message_queue.get_nowait()
-                    send_command(client_socket, msg)
+                message = receiver.read_message()
+                if message is None:
+                    status_message = "Koneksi terputus"
+                    print("Koneksi terputus saat menerima frame")
+                    break
                 
-                header_data = remaining_data if remaining_data else recv_all(client_socket, 16)
-                remaining_data = b""
+                buffer, image_data, width, height, info = message
                 
-                if not header_data or len(header_data) < 16:
-                    print("Koneksi terputus saat menerima header")
-                    break
-                    
-                data_len, width, height = struct.unpack("QII", header_data[:16])
+                if info is not None:
+                    if info.frame_type == protocol.FRAME_CLOCK:
+                        clock_sync.on_reply(image_data)
+                        receiver.release(buffer)
+                        continue
+                    if info.frame_type == protocol.FRAME_CURSOR:
+                        x, y, visible = protocol.CURSOR_PAYLOAD.unpack(image_data)
+                        receiver.release(buffer)
+                        cursor_position = (x, y) if visible else None
+                        cursor_version += 1
+                        continue
+                    if info.frame_type == protocol.FRAME_SESSION:
+                        token, resumed = protocol.SESSION_PAYLOAD.unpack(image_data)
+                        receiver.release(buffer)
+                        if resuming and not resumed:
+                            # Sesi lama sudah tidak ada di server: mulai dari keyframe
+                            # dengan cache tile kosong seperti koneksi baru
+                            applied_seq = -1
+                            reset_tile_cache()
+                        print("Sesi dilanjutkan" if resumed else "Sesi baru")
+                        session_token = token
+                        continue
+                    if info.frame_type == protocol.FRAME_HEARTBEAT:
+                        # Layar server tidak berubah; cukup tanda koneksi masih hidup
+                        receiver.release(buffer)
+                        continue
+                    if info.frame_type not in (protocol.FRAME_IMAGE, protocol.FRAME_RECTS,
+                                               protocol.FRAME_PING, protocol.FRAME_STATS):
+                        # Jenis frame dari versi server yang lebih baru dilewati
+                        receiver.release(buffer)
+                        continue
+                    if info.frame_type in (protocol.FRAME_IMAGE, protocol.FRAME_RECTS):
+                        # Nomor urut mengikuti capture, jadi celahnya adalah frame
+                        # yang digantikan frame lebih baru selama antri di server
+                        if last_seq is not None and info.seq > last_seq + 1:
+                            seq_gaps += info.seq - last_seq - 1
+                        last_seq = info.seq
+                        frames_dropped = seq_gaps + decoder.skipped
                 
-                image_data = recv_all(client_socket, data_len)
-                if not image_data:
-                    print("Koneksi terputus saat menerima data gambar")
-                    break
+                ping_token = protocol.parse_ping(image_data)
+                if ping_token is not None:
+                    receiver.release(buffer)
+                    queue_command("PONG", ping_token)
+                    continue
+                
+                stats = protocol.parse_stats(image_data)
+                if stats is not None:
+                    receiver.release(buffer)
+                    server_stats = stats
+                    continue
                     
                 update_performance_metrics(len(image_data))
                 
-                img_np = np.frombuffer(image_data, dtype=np.uint8)
-                frame = cv2.imdecode(img_np, cv2.IMREAD_COLOR)
-                
-                if frame is not None:
-                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                    
-                    try:
-                        if frame_queue.full():
-                            frame_queue.get_nowait()
-                        frame_queue.put_nowait(frame)
-                    except:
-                        pass
+                # Decode berjalan di thread sendiri agar socket tetap dibaca
+                decoder.submit(buffer, image_data, width, height, info)
             
             except socket.timeout:
-                pass
+                if frame_header and time.time() - receiver.received > SILENCE_TIMEOUT:
+                    # Heartbeat tidak datang lagi: koneksi putus tanpa FIN/RST
+                    # (misalnya berpindah Wi-Fi), jadi sambung ulang dan RESUME
+                    status_message = "Server tidak merespons"
+                    print(f"Tidak ada data dari server selama {SILENCE_TIMEOUT:.0f} detik")
+                    break
             except Exception as e:
                 status_message = f"Error jaringan: {str(e)}"
                 print(f"Network error: {e}")
@@ -153,13 +876,39 @@ def network_thread():
         print(f"Connection error: {e}")
     finally:
         connected = False
+        cursor_position = None
+        message_queue.put(None)
+        if decoder is not None:
+            decoder.close()
         try:
             client_socket.close()
         except:
             pass
+        # applied_seq untuk RESUME baru pasti setelah thread decode berhenti
+        for thread in (sender, decode_thread):
+            if thread is not None:
+                thread.join(2.0)
+    return established
+
+def connection_loop():
+    # Sambung ulang dengan jeda eksponensial (plus jitter agar client tidak
+    # menyerbu server bersamaan); jeda kembali ke awal setelah tersambung
+    global status_message
+    delay = RECONNECT_DELAY
+    while running:
+        if network_thread():
+            delay = RECONNECT_DELAY
+        if not running:
+            break
+        reason = status_message
+        deadline = time.time() + delay * random.uniform(0.5, 1.0)
+        while running and time.time() < deadline:
+            status_message = f"{reason} - menyambung ulang dalam {deadline - time.time():.1f} detik"
+            time.sleep(0.1)
+        delay = min(delay * 2, RECONNECT_MAX_DELAY)
 
 def main():
-    global WINDOW_WIDTH, WINDOW_HEIGHT, FULLSCREEN, running, connected, status_message
+    global WINDOW_WIDTH, WINDOW_HEIGHT, FULLSCREEN, SHOW_BREAKDOWN, running, connected, status_message
     
     pygame.init()
     pygame.display.set_caption("Remote Desktop Client")
@@ -172,12 +921,29 @@ def main():
     
     font = pygame.font.Font(None, 24)
     
-    network_thread_instance = threading.Thread(target=network_thread)
+    network_thread_instance = threading.Thread(target=connection_loop)
     network_thread_instance.daemon = True
     network_thread_instance.start()
     
+    scale_stage.resize(WINDOW_WIDTH, WINDOW_HEIGHT)
+    threading.Thread(target=scale_stage.run, daemon=True, name="scale-stage").start()
+    
     key_states = {}  
     
+    # Surface dibuat sekali untuk tiap buffer milik ScaleStage; thread utama
+    # hanya menampilkan buffer yang sudah siap dan menangani input
+    surfaces = {}
+    current_surface = None
+    refresh_rate = display_refresh_rate()
+    
+    # Kursor lokal disembunyikan selama kursor server digambar di atas frame
+    cursor_image = make_cursor_image()
+    drawn_cursor_version = -1
+    system_cursor_visible = True
+    
+    # Latar overlay dibuat ulang hanya saat jumlah barisnya berubah
+    overlay = None
+    
     clock = pygame.time.Clock()
     
     while running:
@@ -197,6 +963,8 @@ def main():
                 if not FULLSCREEN:
                     WINDOW_WIDTH, WINDOW_HEIGHT = event.size
                     screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT), pygame.RESIZABLE)
+                    scale_stage.resize(WINDOW_WIDTH, WINDOW_HEIGHT)
+                    send_viewport()
             
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_F11:
                 FULLSCREEN = not FULLSCREEN
@@ -205,58 +973,88 @@ def main():
                     WINDOW_WIDTH, WINDOW_HEIGHT = screen.get_size()
                 else:
                     screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT), pygame.RESIZABLE)
+                scale_stage.resize(WINDOW_WIDTH, WINDOW_HEIGHT)
+                send_viewport()
+                refresh_rate = display_refresh_rate()
+            
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F8:
+                paste_clipboard()
+            
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F9:
+                toggle_zoom(*pygame.mouse.get_pos())
+            
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F10:
+                SHOW_BREAKDOWN = not SHOW_BREAKDOWN
             
             elif event.type == pygame.KEYDOWN:
                 key = pygame.key.name(event.key)
                 if key not in key_states:
                     key_states[key] = True
-                    message_queue.put(f"KEY_DOWN {key}")
+                    queue_command("KEY_DOWN", key)
             
             elif event.type == pygame.KEYUP:
                 key = pygame.key.name(event.key)
                 if key in key_states:
                     del key_states[key]
-                    message_queue.put(f"KEY_UP {key}")
+                    queue_command("KEY_UP", key)
             
             elif event.type == pygame.MOUSEMOTION:
                 x, y = pygame.mouse.get_pos()
-                message_queue.put(f"MOUSE_MOVE {x} {y} {WINDOW_WIDTH} {WINDOW_HEIGHT}")
+                queue_command("MOUSE_MOVE", x, y, WINDOW_WIDTH, WINDOW_HEIGHT)
             
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 button = event.button  
                 if button in [4, 5]:
                     scroll_amount = 5 if button == 4 else -5
-                    message_queue.put(f"MOUSE_SCROLL {scroll_amount}")
+                    queue_command("MOUSE_SCROLL", scroll_amount)
                 else:
-                    message_queue.put(f"MOUSE_CLICK {button}")
+                    queue_command("MOUSE_CLICK", button)
             
             elif event.type == pygame.MOUSEWHEEL:
                 scroll_amount = event.y * 3
-                message_queue.put(f"MOUSE_SCROLL {scroll_amount}")
+                queue_command("MOUSE_SCROLL", scroll_amount)
+        
+        if system_cursor_visible != (cursor_position is None):
+            system_cursor_visible = cursor_position is None
+            pygame.mouse.set_visible(system_cursor_visible)
         
         if connected:
             try:
-                if not frame_queue.empty():
-                    frame = frame_queue.get_nowait()
-                    
-                    if frame.shape[1] != WINDOW_WIDTH or frame.shape[0] != WINDOW_HEIGHT:
-                        frame = cv2.resize(frame, (WINDOW_WIDTH, WINDOW_HEIGHT))
-                    
-                    pygame_frame = pygame.surfarray.make_surface(frame.swapaxes(0, 1))
-                    screen.blit(pygame_frame, (0, 0))
+                presented = scale_stage.take()
+                captured = 0
+                if presented is not None:
+                    display_buffer, captured = presented
+                    key = (id(display_buffer), display_buffer.shape)
+                    if key not in surfaces:
+                        height, width = display_buffer.shape[:2]
+                        surfaces = {k: s for k, s in surfaces.items() if k[1] == display_buffer.shape}
+                        surfaces[key] = pygame.image.frombuffer(display_buffer, (width, height), "BGR")
+                    current_surface = surfaces[key]
+                
+                # Gerakan kursor digambar ulang di atas frame terakhir tanpa
+                # menunggu frame baru dari server
+                if current_surface is not None and (presented is not None or cursor_version != drawn_cursor_version):
+                    drawn_cursor_version = cursor_version
+                    present_start = time.perf_counter()
+                    screen.blit(current_surface, (0, 0))
+                    draw_cursor(screen, cursor_image)
                     
-                    overlay = pygame.Surface((250, 80), pygame.SRCALPHA)
-                    overlay.fill((0, 0, 0, 128))
+                    lines = overlay_lines()
+                    if overlay is None or overlay.get_height() != 25 * len(lines) + 5:
+                        overlay = pygame.Surface((300, 25 * len(lines) + 5), pygame.SRCALPHA)
+                        overlay.fill((0, 0, 0, 128))
                     screen.blit(overlay, (10, 10))
                     
-                    fps_text = font.render(f"FPS: {current_fps:.1f}", True, (255, 255, 255))
-                    screen.blit(fps_text, (20, 20))
+                    for index, line in enumerate(lines):
+                        text = font.render(line, True, (255, 255, 255))
+                        screen.blit(text, (20, 20 + 25 * index))
                     
-                    bw_text = font.render(f"Bandwidth: {current_bandwidth:.1f} KB/s", True, (255, 255, 255))
-                    screen.blit(bw_text, (20, 45))
+                    pygame.display.flip()
+                    stage_timings.record("present", time.perf_counter() - present_start)
                     
-                    res_text = font.render(f"Resolution: {server_width}x{server_height}", True, (255, 255, 255))
-                    screen.blit(res_text, (20, 70))
+                    # Latensi capture sampai tampil, butuh selisih jam dari ClockSync
+                    if captured and clock_sync.offset is not None:
+                        stage_timings.record("e2e", (now_us() - clock_sync.to_local(captured)) / 1e6)
             except Exception as e:
                 print(f"Error rendering frame: {e}")
         else:
@@ -264,10 +1062,14 @@ def main():
             text = font.render(status_message, True, (255, 255, 255))
             text_rect = text.get_rect(center=(WINDOW_WIDTH/2, WINDOW_HEIGHT/2))
             screen.blit(text, text_rect)
+            pygame.display.flip()
         
-        pygame.display.flip()
-        
-        clock.tick(60)
+        # Frame ditampilkan mengikuti refresh rate layar; tanpa frame baru
+        # loop hanya memproses input
+        clock.tick(refresh_rate)
+    
+    with frame_changed:
+        frame_changed.notify_all()
     
     pygame.quit()
 
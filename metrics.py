@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+# Pencatat waktu per tahap pipeline untuk server dan client. Setiap tahap
+# memakai ring buffer berukuran tetap, jadi biaya pencatatan konstan dan
+# persentil selalu dihitung dari sampel terbaru.
+
+RING_SIZE = 512
+
+
+class StageTimings:
+    def __init__(self, stages, size=RING_SIZE):
+        self.stages = list(stages)
+        self.size = size
+        self.lock = threading.Lock()
+        self.samples = {stage: np.zeros(size) for stage in self.stages}
+        self.counts = dict.fromkeys(self.stages, 0)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            if stage not in self.samples:
+                self.stages.append(stage)
+                self.samples[stage] = np.zeros(self.size)
+                self.counts[stage] = 0
+            count = self.counts[stage]
+            self.samples[stage][count % self.size] = seconds
+            self.counts[stage] = count + 1
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def reset(self):
+        with self.lock:
+            self.counts = dict.fromkeys(self.stages, 0)
+
+    def summary(self):
+        # {tahap: {"n", "p50", "p90", "p99", "max"}} dalam milidetik
+        with self.lock:
+            windows = [
+                (stage, self.counts[stage], self.samples[stage][:min(self.counts[stage], self.size)] * 1000)
+                for stage in self.stages if self.counts[stage]
+            ]
+        result = {}
+        for stage, count, window in windows:
+            p50, p90, p99 = np.percentile(window, [50, 90, 99])
+            result[stage] = {
+                "n": count,
+                "p50": round(float(p50), 2),
+                "p90": round(float(p90), 2),
+                "p99": round(float(p99), 2),
+                "max": round(float(window.max()), 2),
+            }
+        return result
+
+
+class RateMeter:
+    # Laju event dan byte dalam jendela waktu terakhir. Berbeda dengan selisih
+    # dua frame terakhir, hasilnya stabil dan turun ke nol saat stream berhenti.
+    def __init__(self, window=2.0, size=RING_SIZE):
+        self.window = window
+        self.events = deque(maxlen=size)
+        self.first = None
+
+    def add(self, size=0, now=None):
+        now = time.perf_counter() if now is None else now
+        if self.first is None:
+            self.first = now
+        self.events.append((now, size))
+
+    def rates(self, now=None):
+        # (event per detik, byte per detik)
+        now = time.perf_counter() if now is None else now
+        if self.first is None:
+            return 0.0, 0.0
+        span = min(self.window, now - self.first)
+        if span <= 0:
+            return 0.0, 0.0
+        cutoff = now - self.window
+        count = total = 0
+        for timestamp, size in reversed(self.events):
+            if timestamp < cutoff:
+                break
+            count += 1
+            total += size
+        return count / span, total / span
@@ -0,0 +1,402 @@
+import json
+import struct
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+# Paket delta: beberapa rect yang ditempel client ke framebuffer miliknya.
+# Frame penuh tetap dikirim sebagai JPEG biasa agar client lama tetap jalan.
+TILE_MAGIC = b"RDTL"
+TILE_COUNT = struct.Struct("<4sH")
+TILE_RECT = struct.Struct("<HHHHBI")
+
+ENC_JPEG = 0
+# Lossless untuk teks/UI: zlib dari PALETTE_HEADER, palet RGB (jumlah x 3 byte)
+# lalu satu byte indeks palet per piksel, baris demi baris
+ENC_PALETTE = 1
+
+PALETTE_HEADER = struct.Struct("<H")
+CAP_PALETTE = "PALETTE"
+
+# Bukan gambar: salin rect (x, y, w, h) dari posisi COPY_SOURCE di framebuffer
+# client saat instruksi ini diterapkan. Dipakai untuk scroll, sehingga hanya
+# strip yang baru terlihat yang perlu di-encode. Rect dalam satu paket
+# diterapkan berurutan.
+ENC_COPY = 2
+
+COPY_SOURCE = struct.Struct("<HH")
+CAP_COPY_RECT = "COPYRECT"
+
+# Cache tile berbasis isi. Tile dengan bit CACHE_STORE pada encoding membawa
+# kunci CACHE_KEY_SIZE byte di depan datanya dan disimpan client; ENC_CACHE
+# hanya berisi kunci tile yang sudah ada di cache client. Client meminta cache
+# dengan perintah "CACHE <jumlah tile>" setelah server mengiklankan TILECACHE.
+ENC_CACHE = 3
+CACHE_STORE = 0x80
+CACHE_KEY_SIZE = 8
+CAP_TILE_CACHE = "TILECACHE"
+
+
+class TileCache:
+    # LRU yang dijalankan identik di kedua sisi: server menyimpan kunci sebagai
+    # cermin isi cache client, client menyimpan (encoding, data) tile. Selama
+    # kapasitas server tidak lebih besar, setiap kunci yang dirujuk server
+    # pasti masih ada di client karena keduanya melihat urutan akses yang sama.
+    def __init__(self, entries):
+        self.entries = entries
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def get(self, key):
+        value = self.tiles.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.tiles.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.tiles[key] = value
+        self.tiles.move_to_end(key)
+        while len(self.tiles) > self.entries:
+            self.tiles.popitem(last=False)
+
+
+# Header frame berversi, dipakai setelah client mengirim "CAPS FRAME_V2".
+# Header lama struct.pack("QII", len, w, h) tidak mungkin diawali FRAME_MAGIC
+# (panjang payload akan lebih dari 1 GB), jadi client bisa membaca keduanya
+# dari stream yang sama. header_size memungkinkan versi berikutnya menambah
+# field di akhir tanpa membuat pembaca lama salah posisi.
+CAP_FRAME_HEADER = "FRAME_V2"
+
+LEGACY_HEADER = struct.Struct("QII")
+FRAME_MAGIC = b"RDFH"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("<4sBBBBHHHIqI")
+
+FRAME_IMAGE = 1   # satu gambar penuh (JPEG)
+FRAME_RECTS = 2   # paket rect RDTL
+FRAME_PING = 3
+FRAME_STATS = 4
+FRAME_CLOCK = 5   # balasan PING dari client untuk estimasi selisih jam
+FRAME_HEARTBEAT = 6  # tanpa payload, dikirim saat layar tidak berubah
+FRAME_CURSOR = 7  # posisi kursor; lebar/tinggi header = ukuran layar server
+
+FRAME_SESSION = 8  # token sesi untuk resume, lihat SESSION_PAYLOAD
+
+FLAG_KEYFRAME = 0x1
+
+FrameInfo = namedtuple("FrameInfo", "frame_type encoding flags seq captured")
+
+
+# Resume sesi: client yang mengirim "CAPS RESUME" menerima FRAME_SESSION berisi
+# token. Setelah koneksi putus client menyambung lagi dan mengirim "RESUME
+# <token hex> <seq terakhir yang diterapkan>" sebelum CAPS; selama masa
+# tenggang server melanjutkan sesi lama dan hanya mengirim ulang frame setelah
+# seq itu. Flag resumed 0 berarti sesi baru: cache tile client harus dibuang.
+# Client melaporkan seq yang sudah diterapkan dengan "ACK <seq>" agar server
+# bisa membuang log frame yang tidak lagi perlu dikirim ulang.
+CAP_RESUME = "RESUME"
+SESSION_TOKEN_SIZE = 16
+SESSION_PAYLOAD = struct.Struct(f"<{SESSION_TOKEN_SIZE}sB")
+
+
+# Kanal logis setelah client mengirim "CAPS CHANNELS": setiap pesan FRAME_V2
+# (header + payload) dipotong menjadi chunk CHUNK_HEADER + maksimal CHUNK_SIZE
+# byte. Chunk dari kanal berbeda boleh berselang-seling sehingga pesan kecil
+# tidak menunggu frame besar selesai; chunk satu kanal selalu berurutan dan
+# CHUNK_END menandai chunk terakhir sebuah pesan. Chunk pertama selalu memuat
+# header frame lengkap. Seperti FRAME_MAGIC, CHUNK_MAGIC tidak mungkin menjadi
+# awal header QII.
+CAP_CHANNELS = "CHANNELS"
+CHUNK_MAGIC = b"RDCH"
+CHUNK_HEADER = struct.Struct("<4sBBI")
+CHUNK_END = 0x1
+CHUNK_SIZE = 16 * 1024
+
+# Nomor kanal sekaligus prioritas, dari yang tertinggi
+CHANNEL_CONTROL = 0  # ping, clock, stats, heartbeat
+CHANNEL_CURSOR = 1
+CHANNEL_FRAMES = 2
+CHANNEL_BULK = 3     # cadangan untuk clipboard dan transfer file
+CHANNELS = (CHANNEL_CONTROL, CHANNEL_CURSOR, CHANNEL_FRAMES, CHANNEL_BULK)
+
+
+def pack_chunk(channel, length, last):
+    return CHUNK_HEADER.pack(CHUNK_MAGIC, channel, CHUNK_END if last else 0, length)
+
+
+def pack_header(frame_type, length, width=0, height=0, seq=0, captured=0, flags=0, encoding=0):
+    return FRAME_HEADER.pack(
+        FRAME_MAGIC, FRAME_VERSION, FRAME_HEADER.size, frame_type, encoding,
+        flags, width, height, seq, captured, length)
+
+
+def unpack_header(data):
+    # (panjang, lebar, tinggi, FrameInfo); FrameInfo None untuk header lama
+    if bytes(data[:4]) != FRAME_MAGIC:
+        length, width, height = LEGACY_HEADER.unpack_from(data)
+        return length, width, height, None
+    _, _, _, frame_type, encoding, flags, width, height, seq, captured, length = FRAME_HEADER.unpack_from(data)
+    return length, width, height, FrameInfo(frame_type, encoding, flags, seq, captured)
+
+
+# Balasan PING: (waktu kirim client, waktu server saat menerima), keduanya mikrodetik
+CLOCK_PAYLOAD = struct.Struct("<qq")
+
+# Posisi kursor (x, y dalam koordinat layar server, terlihat), hanya untuk
+# client yang mengirim CAPS CURSOR
+CAP_CURSOR = "CURSOR"
+CURSOR_PAYLOAD = struct.Struct("<iiB")
+
+# Client mengirim "VIEWPORT <lebar> <tinggi> [<x> <y> <w> <h>]" saat terhubung
+# dan setiap ukuran jendela atau zoom berubah. Server meng-encode region
+# (x, y, w, h) layarnya (default seluruh layar) langsung seukuran jendela itu.
+CAP_VIEWPORT = "VIEWPORT"
+
+
+# Probe RTT dari server, dikirim di stream frame dengan header QII berukuran 0x0.
+# Client lama akan gagal men-decode payload ini dan mengabaikannya.
+PING_MAGIC = b"RDPI"
+PING_PAYLOAD = struct.Struct("<4sQ")
+
+
+def pack_ping(token):
+    return PING_PAYLOAD.pack(PING_MAGIC, token)
+
+
+def parse_ping(payload):
+    if len(payload) != PING_PAYLOAD.size or bytes(payload[:4]) != PING_MAGIC:
+        return None
+    return PING_PAYLOAD.unpack(payload)[1]
+
+
+# Statistik tahap pipeline dari server sebagai JSON, dikirim seperti ping
+# (header QII 0x0) sebagai balasan perintah teks METRICS dari client
+STATS_MAGIC = b"RDST"
+
+
+def pack_stats(stats):
+    return STATS_MAGIC + json.dumps(stats).encode()
+
+
+def parse_stats(payload):
+    if bytes(payload[:4]) != STATS_MAGIC:
+        return None
+    try:
+        return json.loads(bytes(payload[4:]))
+    except ValueError:
+        return None
+
+
+def pack_rects(rects):
+    parts = [TILE_COUNT.pack(TILE_MAGIC, len(rects))]
+    for x, y, w, h, encoding, data in rects:
+        parts.append(TILE_RECT.pack(x, y, w, h, encoding, len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def is_rect_packet(payload):
+    return bytes(payload[:4]) == TILE_MAGIC
+
+
+def unpack_rects(payload):
+    _, count = TILE_COUNT.unpack_from(payload, 0)
+    offset = TILE_COUNT.size
+    rects = []
+    for _ in range(count):
+        x, y, w, h, encoding, length = TILE_RECT.unpack_from(payload, offset)
+        offset += TILE_RECT.size
+        rects.append((x, y, w, h, encoding, payload[offset:offset + length]))
+        offset += length
+    return rects
+
+
+def covers_frame(rects, width, height):
+    # Benar untuk keyframe: rect-rect (boleh tumpang tindih) yang bersama-sama
+    # menutup seluruh layar. Luas total dicek dulu sebagai penolakan cepat untuk
+    # delta biasa; sisanya diperiksa pada grid dari semua batas rect. COPY dan
+    # MOTION bergantung pada isi sebelumnya, jadi hanya rect sebelum COPY atau
+    # MOTION pertama yang dihitung: COPY bisa membaca piksel dari paket lama
+    # yang belum tertimpa rect sebelumnya di paket ini.
+    dependent = [index for index, rect in enumerate(rects) if rect[4] in (ENC_COPY, ENC_MOTION)]
+    rects = rects[:dependent[0]] if dependent else rects
+    if sum(rect[2] * rect[3] for rect in rects) < width * height:
+        return False
+    xs = sorted({0, width}.union(*((rect[0], rect[0] + rect[2]) for rect in rects)))
+    ys = sorted({0, height}.union(*((rect[1], rect[1] + rect[3]) for rect in rects)))
+    covered = np.zeros((len(ys) - 1, len(xs) - 1), dtype=bool)
+    for x, y, w, h in (rect[:4] for rect in rects):
+        covered[bisect_left(ys, y):bisect_left(ys, y + h), bisect_left(xs, x):bisect_left(xs, x + w)] = True
+    return bool(covered[:bisect_left(ys, height), :bisect_left(xs, width)].all())
+
+
+# Kodek temporal untuk tile yang terus berubah (video, animasi) setelah client
+# mengirim "CAPS MOTION". Kedua sisi menyimpan referensi seukuran frame yang
+# hanya diubah rect ENC_MOTION, terpisah dari framebuffer yang ditampilkan.
+# Data rect: MOTION_HEADER (mode, jumlah vektor, panjang indeks), vektor
+# MOTION_VECTOR, indeks vektor per blok MOTION_BLOCK x MOTION_BLOCK (zlib,
+# baris demi baris) lalu JPEG.
+#   MOTION_INTRA: JPEG berisi piksel rect; hasil decode menjadi referensi.
+#   MOTION_INTER: JPEG berisi residual + 128 terhadap prediksi dari referensi
+#     rect yang sama, tiap blok digeser vektornya (dijepit ke tepi rect).
+#     Vektor pertama selalu (0, 0).
+# INTER hanya merujuk area yang sudah diisi INTRA sejak reset kodek server
+# (keyframe hasil encode), jadi client yang mulai dari snapshot hub mendapat
+# referensi yang sama.
+ENC_MOTION = 4
+CAP_MOTION = "MOTION"
+MOTION_HEADER = struct.Struct("<BBH")
+MOTION_VECTOR = struct.Struct("<bb")
+MOTION_INTRA = 0
+MOTION_INTER = 1
+MOTION_BLOCK = 16
+MOTION_RANGE = 16  # geseran maksimum vektor, piksel
+
+
+def pad_reference(reference, rect):
+    # Referensi rect dengan tepi diperpanjang MOTION_RANGE piksel, ditambah satu
+    # blok di kanan/bawah agar blok terakhir yang terpotong bisa dibaca utuh
+    x, y, w, h = rect
+    edge = (MOTION_RANGE, MOTION_RANGE + MOTION_BLOCK)
+    return np.pad(reference[y:y + h, x:x + w], (edge, edge, (0, 0)), mode="edge")
+
+
+def motion_window(padded, indices, vector):
+    # Isi rect yang digeser vector, sebagai blok (baris, y, kolom, x, kanal)
+    rows, cols = indices.shape
+    top, left = MOTION_RANGE + vector[1], MOTION_RANGE + vector[0]
+    window = padded[top:top + rows * MOTION_BLOCK, left:left + cols * MOTION_BLOCK]
+    return window.reshape(rows, MOTION_BLOCK, cols, MOTION_BLOCK, window.shape[2])
+
+
+def predict_motion(padded, width, height, vectors, indices):
+    prediction = motion_window(padded, indices, (0, 0)).copy()
+    for index in range(1, len(vectors)):
+        rows, cols = np.nonzero(indices == index)
+        if len(rows):
+            prediction[rows, :, cols] = motion_window(padded, indices, vectors[index])[rows, :, cols]
+    rows, cols = indices.shape
+    return prediction.reshape(rows * MOTION_BLOCK, cols * MOTION_BLOCK, -1)[:height, :width]
+
+
+def apply_residual(prediction, residual):
+    return np.clip(prediction.astype(np.int16) + residual - 128, 0, 255).astype(np.uint8)
+
+
+def pack_motion(mode, image, vectors=(), indices=None):
+    packed = b"" if indices is None else zlib.compress(indices.tobytes())
+    parts = [MOTION_HEADER.pack(mode, len(vectors), len(packed))]
+    parts.extend(MOTION_VECTOR.pack(*vector) for vector in vectors)
+    parts.append(packed)
+    parts.append(image)
+    return b"".join(parts)
+
+
+def unpack_motion(data, width, height):
+    # (mode, vektor, indeks blok atau None, JPEG)
+    mode, count, length = MOTION_HEADER.unpack_from(data)
+    offset = MOTION_HEADER.size
+    vectors = [MOTION_VECTOR.unpack_from(data, offset + index * MOTION_VECTOR.size) for index in range(count)]
+    offset += count * MOTION_VECTOR.size
+    indices = None
+    if length:
+        blocks = (-(-height // MOTION_BLOCK), -(-width // MOTION_BLOCK))
+        indices = np.frombuffer(zlib.decompress(data[offset:offset + length]), dtype=np.uint8).reshape(blocks)
+    return mode, vectors, indices, data[offset + length:]
+
+
+# Event input biner ukuran tetap dari client ke server. Byte pertama selalu
+# INPUT_MARKER yang tidak pernah muncul di awal baris protokol teks, jadi kedua
+# format bisa dicampur di satu stream.
+CAP_BINARY_INPUT = "BIN_INPUT"
+
+INPUT_MARKER = 0x01
+INPUT_EVENT = struct.Struct("<BBiiHH")
+
+INPUT_TYPES = {
+    1: "MOUSE_MOVE",
+    2: "MOUSE_CLICK",
+    3: "MOUSE_SCROLL",
+    4: "KEY_DOWN",
+    5: "KEY_UP",
+    6: "KEY_PRESS",
+}
+INPUT_CODES = {name: code for code, name in INPUT_TYPES.items()}
+
+# Teks utuh (mis. hasil paste) dikirim sebagai satu baris "TYPE_TEXT <string
+# JSON>" dan diketik server dalam satu burst, bukan KEY_DOWN/KEY_UP per karakter
+CAP_TYPE_TEXT = "TYPE_TEXT"
+
+# Tombol khusus dikodekan setelah rentang codepoint unicode
+SPECIAL_KEY_BASE = 0x110000
+SPECIAL_KEY_NAMES = [
+    "return", "space", "backspace", "tab", "escape", "delete",
+    "up", "down", "left", "right", "home", "end", "page_up", "page_down",
+    "f1", "f2", "f3", "f4", "f5", "f6", "f7", "f8", "f9", "f10", "f11", "f12",
+    "ctrl", "alt", "shift",
+]
+
+
+def encode_key(name):
+    if len(name) == 1:
+        return ord(name)
+    if name in SPECIAL_KEY_NAMES:
+        return SPECIAL_KEY_BASE + SPECIAL_KEY_NAMES.index(name)
+    return None
+
+
+def decode_key(code):
+    # Kode dari event biner berupa int32 bertanda; nilai di luar kode Unicode
+    # dan tombol khusus yang dikenal menjadi None, bukan error
+    if code < 0:
+        return None
+    if code < SPECIAL_KEY_BASE:
+        return chr(code)
+    index = code - SPECIAL_KEY_BASE
+    if index < len(SPECIAL_KEY_NAMES):
+        return SPECIAL_KEY_NAMES[index]
+    return None
+
+
+def pack_input(cmd_type, a=0, b=0, w=0, h=0):
+    return INPUT_EVENT.pack(INPUT_MARKER, INPUT_CODES[cmd_type], a, b, w, h)
+
+
+def coalesce_moves(commands):
+    # Dari beberapa MOUSE_MOVE berturut-turut hanya posisi terakhir yang dipakai;
+    # urutan terhadap klik dan tombol tetap terjaga
+    return [
+        command for command, next_command in zip(commands, commands[1:] + [None])
+        if not (command[0] == "MOUSE_MOVE" and next_command and next_command[0] == "MOUSE_MOVE")
+    ]
+
+
+def split_input(buffer):
+    # Pisahkan buffer menjadi event biner (tuple) dan baris teks (str);
+    # sisa yang belum lengkap dikembalikan untuk dibaca berikutnya
+    items = []
+    offset = 0
+    while offset < len(buffer):
+        if buffer[offset] == INPUT_MARKER:
+            if len(buffer) - offset < INPUT_EVENT.size:
+                break
+            _, code, a, b, w, h = INPUT_EVENT.unpack_from(buffer, offset)
+            offset += INPUT_EVENT.size
+            if code in INPUT_TYPES:
+                items.append((INPUT_TYPES[code], a, b, w, h))
+        else:
+            end = buffer.find(b"\n", offset)
+            if end < 0:
+                break
+            items.append(bytes(buffer[offset:end]).decode(errors="ignore"))
+            offset = end + 1
+    return items, buffer[offset:]
@@ -0,0 +1,126 @@
+import mmap
+import struct
+import time
+from bisect import bisect_right
+
+import protocol
+
+# Format file rekaman sesi, hanya ditambah di akhir:
+#   FILE_HEADER, lalu record (RECORD_HEADER + payload) berturut-turut; saat
+#   rekaman ditutup normal ditambah record INDEX dan TRAILER.
+# Waktu record dalam mikrodetik sejak awal rekaman dan tidak pernah mundur.
+# Payload UPDATE adalah paket rect RDTL persis seperti hasil encode server.
+# UPDATE dengan FLAG_KEYFRAME bisa diputar dari layar kosong sehingga menjadi
+# titik seek. INPUT berisi JSON {"addr", "cmd", "args"}, CURSOR berisi
+# protocol.CURSOR_PAYLOAD. INDEX berisi (waktu, offset) semua keyframe; file
+# tanpa TRAILER (server mati saat merekam) di-index ulang dengan memindai record.
+RECORD_MAGIC = b"RDRC"
+RECORD_VERSION = 1
+FILE_HEADER = struct.Struct("<4sBHHq")    # magic, versi, lebar, tinggi layar, waktu mulai (unix, mikrodetik)
+RECORD_HEADER = struct.Struct("<BBHHqI")  # jenis, flag, lebar, tinggi, waktu, panjang payload
+INDEX_ENTRY = struct.Struct("<qQ")
+INDEX_MAGIC = b"RDIX"
+TRAILER = struct.Struct("<4sQ")           # INDEX_MAGIC, offset record INDEX
+
+RECORD_UPDATE = 1
+RECORD_INPUT = 2
+RECORD_CURSOR = 3
+RECORD_INDEX = 4
+
+
+class RecordingWriter:
+    # Tidak thread-safe; server memanggilnya dari satu thread rekaman saja
+    def __init__(self, path, width, height):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(FILE_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, width, height, time.time_ns() // 1000))
+        self.offset = FILE_HEADER.size
+        self.last_time = 0
+        self.index = []
+        self.records = 0
+
+    def write(self, kind, time_us, payload, flags=0, width=0, height=0):
+        time_us = max(time_us, self.last_time)
+        self.last_time = time_us
+        self.file.write(RECORD_HEADER.pack(kind, flags, width, height, time_us, len(payload)))
+        self.file.write(payload)
+        if flags & protocol.FLAG_KEYFRAME:
+            self.index.append((time_us, self.offset))
+            # Rekaman yang terputus tetap bisa diputar sampai keyframe terakhir
+            self.file.flush()
+        self.offset += RECORD_HEADER.size + len(payload)
+        self.records += 1
+
+    def write_update(self, rects, width, height, time_us, flags=0):
+        self.write(RECORD_UPDATE, time_us, protocol.pack_rects(rects), flags, width, height)
+
+    def close(self):
+        index_offset = self.offset
+        self.write(RECORD_INDEX, self.last_time, b"".join(INDEX_ENTRY.pack(*entry) for entry in self.index))
+        self.file.write(TRAILER.pack(INDEX_MAGIC, index_offset))
+        self.file.close()
+
+
+class RecordingReader:
+    # File di-mmap; payload record berupa memoryview langsung ke file
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < FILE_HEADER.size:
+            raise ValueError(f"File rekaman terlalu pendek: {path}")
+        magic, version, self.width, self.height, self.started = FILE_HEADER.unpack_from(self.data)
+        if magic != RECORD_MAGIC:
+            raise ValueError(f"Bukan file rekaman: {path}")
+        if version != RECORD_VERSION:
+            raise ValueError(f"Versi rekaman tidak didukung: {version}")
+        self.index, self.duration = self.read_index()
+        self.times = [time_us for time_us, _ in self.index]
+
+    def read_index(self):
+        # (index keyframe, durasi dalam mikrodetik)
+        if len(self.data) >= FILE_HEADER.size + RECORD_HEADER.size + TRAILER.size:
+            magic, offset = TRAILER.unpack_from(self.data, len(self.data) - TRAILER.size)
+            if magic == INDEX_MAGIC and offset + RECORD_HEADER.size <= len(self.data) - TRAILER.size:
+                kind, _, _, _, time_us, length = RECORD_HEADER.unpack_from(self.data, offset)
+                start = offset + RECORD_HEADER.size
+                if kind == RECORD_INDEX and start + length == len(self.data) - TRAILER.size:
+                    entries = [INDEX_ENTRY.unpack_from(self.data, position)
+                               for position in range(start, start + length, INDEX_ENTRY.size)]
+                    return entries, time_us
+
+        # Rekaman tidak ditutup normal: keyframe dicari dari header record saja
+        index = []
+        duration = 0
+        for offset, kind, flags, _, _, time_us, _ in self.records():
+            if kind == RECORD_UPDATE and flags & protocol.FLAG_KEYFRAME:
+                index.append((time_us, offset))
+            duration = time_us
+        return index, duration
+
+    def records(self, offset=FILE_HEADER.size):
+        # (offset, jenis, flag, lebar, tinggi, waktu, payload) mulai dari offset;
+        # berhenti di record INDEX atau record terakhir yang terpotong
+        end = len(self.data)
+        while offset + RECORD_HEADER.size <= end:
+            kind, flags, width, height, time_us, length = RECORD_HEADER.unpack_from(self.data, offset)
+            start = offset + RECORD_HEADER.size
+            if kind == RECORD_INDEX or start + length > end:
+                return
+            yield offset, kind, flags, width, height, time_us, memoryview(self.data)[start:start + length]
+            offset = start + length
+
+    def seek(self, time_us):
+        # Offset keyframe terakhir yang tidak lebih lambat dari time_us
+        position = bisect_right(self.times, time_us) - 1
+        if position < 0:
+            return self.index[0][1] if self.index else FILE_HEADER.size
+        return self.index[position][1]
+
+    def close(self):
+        try:
+            self.data.close()
+        except BufferError:
+            # Masih ada payload memoryview yang dipakai; mmap dilepas bersama objeknya
+            pass
+        self.file.close()
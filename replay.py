@@ -0,0 +1,161 @@
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+
+import protocol
+import recording
+import server
+
+# Memutar ulang rekaman dari server --record ke client biasa. Update yang
+# tersimpan dipublikasikan ke FrameHub layar penuh apa adanya, tanpa capture
+# maupun encode, lalu dikirim oleh ClientOutbox server seperti sesi live.
+# Input dari client replay diterima tapi tidak pernah dieksekusi.
+
+PORT = 9999
+SPEED = 1.0  # 2.0 = dua kali lebih cepat, 0 = secepat mungkin
+
+
+class ReplaySource:
+    # Pengganti backend capture: server hanya butuh ukuran layar rekaman
+    name = "replay"
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def size(self):
+        return self.width, self.height
+
+    def cursor(self):
+        return None
+
+    def close(self):
+        pass
+
+
+def format_time(time_us):
+    seconds = time_us / 1e6
+    return f"{int(seconds // 60):02d}:{seconds % 60:06.3f}"
+
+
+def parse_time(value):
+    # "90", "90.5" atau "1:30" menjadi mikrodetik
+    seconds = 0.0
+    for part in value.split(":"):
+        seconds = seconds * 60 + float(part)
+    return int(seconds * 1e6)
+
+
+def apply_record(hub, kind, flags, width, height, time_us, payload):
+    if kind == recording.RECORD_UPDATE:
+        # Payload di-mmap; data disalin agar tidak menahan file selama dipakai outbox
+        rects = [(x, y, w, h, encoding, bytes(data))
+                 for x, y, w, h, encoding, data in protocol.unpack_rects(payload)]
+        keyframe = rects if flags & protocol.FLAG_KEYFRAME else None
+        hub.publish(rects, width, height, keyframe, time.monotonic_ns() // 1000)
+
+    elif kind == recording.RECORD_CURSOR:
+        x, y, _ = protocol.CURSOR_PAYLOAD.unpack(payload)
+        server.cursor_position = (x, y)
+        for outbox in server.active_outboxes:
+            outbox.send_cursor((x, y))
+
+    elif kind == recording.RECORD_INPUT:
+        event = json.loads(bytes(payload))
+        if event["cmd"] != "MOUSE_MOVE":
+            logging.info(f"[{format_time(time_us)}] Input {event['addr']}: {event['cmd']} {event['args']}")
+
+
+async def replay_loop(reader, start, speed, repeat):
+    loop = asyncio.get_running_loop()
+    hub = server.frame_hubs.hubs[None]
+
+    while True:
+        # Record sebelum titik mulai (sejak keyframe terdekat) diputar tanpa jeda
+        base = None
+        for _, kind, flags, width, height, time_us, payload in reader.records(reader.seek(start)):
+            if not server.frame_hubs.watched.is_set():
+                logging.info(f"Replay dijeda di {format_time(time_us)} sampai ada viewer")
+                await server.frame_hubs.watched.wait()
+                base = None
+
+            target = max(time_us, start)
+            if base is None:
+                base = (loop.time(), target)
+            delay = base[0] + (target - base[1]) / 1e6 / speed - loop.time() if speed > 0 else 0
+            await asyncio.sleep(max(0.0, delay))
+            apply_record(hub, kind, flags, width, height, time_us, payload)
+
+        logging.info(f"Replay selesai ({format_time(reader.duration)})")
+        if not repeat:
+            return
+
+
+async def serve(reader, args):
+    server.capture_source = ReplaySource(reader.width, reader.height)
+    server.input_executor = server.InputExecutor(server.NullInjector())
+    server.PORT = args.port
+    # Rekaman hanya berisi layar penuh, jadi client tidak ditawari viewport
+    server.SERVER_CAPABILITIES = [cap for cap in server.SERVER_CAPABILITIES if cap != protocol.CAP_VIEWPORT]
+
+    try:
+        server_socket = server.create_server_socket()
+    except OSError as e:
+        logging.error(f"Gagal membuat socket server: {e}")
+        sys.exit(1)
+
+    replay_task = asyncio.create_task(replay_loop(reader, parse_time(args.start), args.speed, args.loop))
+    replay_server = await asyncio.start_server(server.handle_client, sock=server_socket)
+    logging.info(f"Replay {reader.path} di {server.HOST}:{server.PORT}, kecepatan {args.speed}x")
+
+    try:
+        async with replay_server:
+            await replay_server.serve_forever()
+    finally:
+        server.stop_event.set()
+        replay_task.cancel()
+
+
+def describe(reader):
+    started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(reader.started / 1e6))
+    counts = {}
+    for _, kind, _, _, _, _, _ in reader.records():
+        counts[kind] = counts.get(kind, 0) + 1
+    print(f"{reader.path}: layar {reader.width}x{reader.height}, mulai {started}, "
+          f"durasi {format_time(reader.duration)}")
+    print(f"  {counts.get(recording.RECORD_UPDATE, 0)} update, {len(reader.index)} keyframe, "
+          f"{counts.get(recording.RECORD_INPUT, 0)} input, {counts.get(recording.RECORD_CURSOR, 0)} kursor")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Putar ulang rekaman sesi remote desktop")
+    parser.add_argument("recording", help="file dari server.py --record")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--speed", type=float, default=SPEED,
+                        help="kelipatan kecepatan; 0 = secepat mungkin")
+    parser.add_argument("--start", default="0",
+                        help="mulai dari detik ke-N atau menit:detik, lewat index keyframe")
+    parser.add_argument("--loop", action="store_true", help="ulangi dari titik mulai setelah selesai")
+    parser.add_argument("--info", action="store_true", help="tampilkan ringkasan rekaman lalu keluar")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    reader = recording.RecordingReader(args.recording)
+    try:
+        if args.info:
+            describe(reader)
+            return
+        asyncio.run(serve(reader, args))
+    except KeyboardInterrupt:
+        logging.info("Replay dihentikan oleh pengguna")
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
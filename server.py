@@ -1,15 +1,33 @@
 import socket
 import struct
-import pyautogui
-from pynput.mouse import Controller as MouseController
-from pynput.mouse import Button as MouseButton
-from pynput.keyboard import Controller as KeyboardController, Key
+try:
+    from pynput.mouse import Controller as MouseController
+    from pynput.mouse import Button as MouseButton
+    from pynput.keyboard import Controller as KeyboardController, Key
+except ImportError:
+    # Tanpa pynput (server headless, benchmark) hanya injector "null" yang tersedia
+    MouseController = MouseButton = KeyboardController = Key = None
 import io
 import time
 import threading
 import queue
 import logging
 import sys
+import os
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, deque
+import numpy as np
+from PIL import Image
+import json
+import zlib
+import hashlib
+import secrets
+import protocol
+import capture
+import metrics
+import recording
 
 logging.basicConfig(
     level=logging.INFO,
@@ -22,14 +40,73 @@ logging.basicConfig(
 
 HOST = '0.0.0.0'
 PORT = 9999
+CAPTURE_BACKEND = "pyautogui"  # pyautogui, mss, atau synthetic (lihat --capture)
 QUALITY = 60       
 FPS_LIMIT = 20     
 SCREEN_SCALE = 0.8 
-MAX_SEND_RETRIES = 3 
-SEND_TIMEOUT = 3.0   
-RECV_TIMEOUT = 0.5    
+IDLE_TIMEOUT = 30.0
+HEARTBEAT_INTERVAL = 2.0  # heartbeat ke client FRAME_V2 selama layar tidak berubah
+CURSOR_RATE = 60  # frekuensi pembacaan posisi kursor (Hz) untuk client CURSOR
+OUTBOX_HIGH_WATER = 256 * 1024  # frame ditahan selama buffer kirim di atas batas ini
+HANDSHAKE_TIMEOUT = 0.5  # frame pertama menunggu CAPS/RESUME dari client selama ini
+SESSION_GRACE = 30.0     # detik sesi client RESUME disimpan setelah koneksi putus
+SESSION_LOG_BYTES = 16 * 1024 * 1024  # batas frame terkirim yang belum di-ACK per sesi
+
+# Pengaturan kualitas adaptif: (kualitas JPEG, skala layar, batas FPS),
+# dari yang terbaik sampai yang paling hemat bandwidth
+ADAPTIVE_QUALITY = True
+QUALITY_LEVELS = [
+    (80, 1.0, 30),
+    (70, 0.9, 25),
+    (QUALITY, SCREEN_SCALE, FPS_LIMIT),
+    (50, 0.7, 15),
+    (40, 0.6, 12),
+    (30, 0.5, 10),
+    (25, 0.4, 8),
+]
+TARGET_LATENCY_MS = 150
+TARGET_BANDWIDTH_KBPS = 0  # 0 = tanpa batas
+CONTROL_INTERVAL = 1.0
+DELTA_MODE = True     # kirim hanya tile yang berubah
+TILE_SIZE = 64
+ENCODE_WORKERS = os.cpu_count() or 1  # stripe/tile di-encode paralel
+
+# Pemilihan kodek per tile: teks/UI (sedikit warna, banyak tepi tajam) dikirim
+# lossless dengan palet+zlib, area foto/video tetap JPEG. Aktif hanya bila
+# semua viewer mengirim CAPS PALETTE.
+CONTENT_AWARE = True
+PALETTE_MAX_COLORS = 256
+FLAT_MAX_COLORS = 32       # UI datar selalu lossless walau tepinya sedikit
+TEXT_EDGE_DENSITY = 0.04   # proporsi piksel bertepi tajam untuk dianggap teks
+EDGE_THRESHOLD = 48
+PALETTE_LEVEL = 6          # level kompresi zlib
+
+# Deteksi scroll: geseran vertikal atau horizontal antar frame dicari lewat
+# hash per baris/kolom, lalu dikirim sebagai instruksi COPY dari framebuffer
+# client ditambah strip yang baru terlihat. Aktif hanya bila semua viewer
+# mengirim CAPS COPYRECT.
+SCROLL_DETECTION = True
+SCROLL_MIN_TILES = 4   # tile berubah minimal sebelum geseran dicari
+SCROLL_MIN_LINES = 8   # baris/kolom cocok minimal untuk satu instruksi COPY
+
+# Kodek temporal untuk tile yang berubah dua frame berturut-turut (video,
+# animasi): residual terhadap frame sebelumnya yang sudah dikompensasi gerak,
+# dengan JPEG biasa sebagai cadangan per rect. Aktif hanya bila semua viewer
+# sebuah hub mengirim CAPS MOTION.
+MOTION_CODEC = "block"  # block, atau jpeg untuk mematikan (lihat --motion-codec)
 
-SPECIAL_KEYS = {
+# Cache tile berbasis isi: dengan cache, setiap tile dikirim dengan kunci hash
+# isinya dan tile yang sudah dimiliki client cukup dirujuk dengan kunci itu.
+# Juga kapasitas maksimum cermin cache per client dan cache hasil encode.
+TILE_CACHE_ENTRIES = 4096  # 0 = matikan
+MAX_VIEWERS = 8
+INPUT_INJECTOR = "pynput"  # pynput, null (input diterima tanpa dieksekusi) atau recording (dicatat)
+METRICS_FILE = None    # path JSON yang ditulis ulang tiap METRICS_INTERVAL (lihat --metrics-file)
+METRICS_INTERVAL = 5.0
+RECORD_FILE = None     # file rekaman sesi (lihat --record); diputar ulang dengan replay.py
+RECORD_KEYFRAME_INTERVAL = 10.0  # detik antar keyframe, titik seek di rekaman
+
+SPECIAL_KEYS = {} if Key is None else {
     "return": Key.enter,
     "space": Key.space,
     "backspace": Key.backspace,
@@ -50,293 +127,1750 @@ SPECIAL_KEYS = {
     "ctrl": Key.ctrl, "alt": Key.alt, "shift": Key.shift
 }
 
-try:
+MOUSE_BUTTONS = {1: "left", 2: "middle", 3: "right"} if MouseButton is None else {
+    1: MouseButton.left,
+    2: MouseButton.middle,
+    3: MouseButton.right
+}
+
+def create_server_socket():
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1048576)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)
     server_socket.bind((HOST, PORT))
-    server_socket.listen(1)
-    logging.info(f"Server berjalan di {HOST}:{PORT}")
-    logging.info("Menunggu koneksi dari client...")
-except OSError as e:
-    logging.error(f"Gagal membuat socket server: {e}")
-    sys.exit(1)
+    server_socket.listen(MAX_VIEWERS)
+    server_socket.setblocking(False)
+    return server_socket
 
 command_queue = queue.Queue()
-screenshot_queue = queue.Queue(maxsize=2)  
 
 stop_event = threading.Event()
+capture_source = None
+cursor_controller = None  # pembaca posisi kursor cadangan bila backend capture tidak bisa
+cursor_position = None
+session_recorder = None
+input_executor = None
 
-def safe_send(conn, data, retries=MAX_SEND_RETRIES):
-    conn.settimeout(SEND_TIMEOUT)
-    for attempt in range(retries):
-        try:
-            conn.sendall(data)
-            return True
-        except (socket.timeout, ConnectionResetError, BrokenPipeError) as e:
-            if attempt < retries - 1:
-                logging.warning(f"Pengiriman gagal (percobaan {attempt+1}/{retries}): {e}")
-                time.sleep(0.2) 
+# Waktu tiap tahap pipeline server; "queue" adalah lama update menunggu
+# di FrameSubscription sebelum ditulis ke socket
+SERVER_STAGES = ("capture", "resize", "encode", "queue", "send", "input")
+stage_timings = metrics.StageTimings(SERVER_STAGES)
+encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
+
+def encode_jpeg(pixels, quality):
+    img_bytes = io.BytesIO()
+    Image.fromarray(pixels).save(img_bytes, format="JPEG", quality=quality)
+    return img_bytes.getvalue()
+
+def decode_jpeg(data):
+    return np.asarray(Image.open(io.BytesIO(data)).convert("RGB"))
+
+def find_dirty_tiles(frame, prev_frame):
+    height, width = frame.shape[:2]
+    rows = -(-height // TILE_SIZE)
+    cols = -(-width // TILE_SIZE)
+    
+    changed = np.zeros((rows * TILE_SIZE, cols * TILE_SIZE), dtype=bool)
+    np.any(frame != prev_frame, axis=2, out=changed[:height, :width])
+    return changed.reshape(rows, TILE_SIZE, cols, TILE_SIZE).any(axis=(1, 3))
+
+def dirty_rects(tile_mask, width, height):
+    # Gabungkan tile berurutan dalam satu baris menjadi satu rect
+    rects = []
+    for row, cols in enumerate(tile_mask):
+        dirty_cols = np.flatnonzero(cols)
+        if not len(dirty_cols):
+            continue
+        run_starts = np.flatnonzero(np.diff(dirty_cols) != 1) + 1
+        for run in np.split(dirty_cols, run_starts):
+            x = int(run[0]) * TILE_SIZE
+            y = row * TILE_SIZE
+            w = min((int(run[-1]) + 1) * TILE_SIZE, width) - x
+            h = min(y + TILE_SIZE, height) - y
+            rects.append((x, y, w, h))
+    return rects
+
+def stripe_rects(width, height):
+    # Keyframe dipotong menjadi stripe horizontal yang bisa di-encode dan
+    # di-decode terpisah; sekitar dua stripe per worker agar beban rata
+    if ENCODE_WORKERS == 1:
+        return [(0, 0, width, height)]
+    stripe = -(-height // (2 * ENCODE_WORKERS))
+    stripe = max(TILE_SIZE, -(-stripe // TILE_SIZE) * TILE_SIZE)
+    return [(0, y, width, min(stripe, height - y)) for y in range(0, height, stripe)]
+
+def classify_region(pixels):
+    # Kembalikan (warna, indeks) bila region lebih cocok dikirim lossless,
+    # None bila sebaiknya JPEG. Sampel jarang menolak area foto dengan cepat
+    # sebelum np.unique dijalankan untuk seluruh piksel.
+    packed = (pixels[..., 0].astype(np.uint32) << 16) | (pixels[..., 1].astype(np.uint32) << 8) | pixels[..., 2]
+    if len(np.unique(packed[::2, ::2])) > PALETTE_MAX_COLORS:
+        return None
+    colors, indices = np.unique(packed, return_inverse=True)
+    if len(colors) > PALETTE_MAX_COLORS:
+        return None
+    if len(colors) > FLAT_MAX_COLORS:
+        edges = np.abs(np.diff(pixels.astype(np.int16), axis=1)).max(axis=2) > EDGE_THRESHOLD
+        if edges.mean() < TEXT_EDGE_DENSITY:
+            return None
+    return colors, indices
+
+def encode_palette(colors, indices):
+    palette = np.stack([colors >> 16, colors >> 8, colors], axis=1).astype(np.uint8)
+    data = protocol.PALETTE_HEADER.pack(len(colors)) + palette.tobytes() + indices.astype(np.uint8).tobytes()
+    return zlib.compress(data, PALETTE_LEVEL)
+
+def split_cells(rect):
+    x, y, w, h = rect
+    return [
+        (cx, cy, min(TILE_SIZE, x + w - cx), min(TILE_SIZE, y + h - cy))
+        for cy in range(y, y + h, TILE_SIZE) for cx in range(x, x + w, TILE_SIZE)
+    ]
+
+def plan_rect(frame, rect):
+    # Pecah rect menjadi tile palet dan run JPEG per baris tile. Rect yang
+    # seluruhnya foto tetap satu JPEG agar header JPEG tidak berulang.
+    cells = split_cells(rect)
+    palettes = [classify_region(frame[y:y + h, x:x + w]) for x, y, w, h in cells]
+    if all(palette is None for palette in palettes):
+        return [(rect, None)]
+    
+    regions = []
+    run = None
+    for cell, palette in zip(cells, palettes):
+        if palette is None and run is not None and run[1] == cell[1] and run[0] + run[2] == cell[0]:
+            run = (run[0], run[1], run[2] + cell[2], run[3])
+            continue
+        if run is not None:
+            regions.append((run, None))
+            run = None
+        if palette is None:
+            run = cell
+        else:
+            regions.append((cell, palette))
+    if run is not None:
+        regions.append((run, None))
+    return regions
+
+def encode_rects(frame, rects, quality, lossless=False):
+    def encode(region):
+        (x, y, w, h), palette = region
+        if palette is not None:
+            return (x, y, w, h, protocol.ENC_PALETTE, encode_palette(*palette))
+        return (x, y, w, h, protocol.ENC_JPEG, encode_jpeg(frame[y:y + h, x:x + w], quality))
+    
+    def plan(rect):
+        return plan_rect(frame, rect)
+    
+    # Encoder JPEG Pillow, np.unique dan zlib melepas GIL, jadi thread pool
+    # cukup untuk memakai semua core
+    parallel = len(rects) >= 2 and ENCODE_WORKERS > 1
+    if lossless:
+        plans = encode_pool.map(plan, rects) if parallel else map(plan, rects)
+        regions = [region for regions in plans for region in regions]
+    else:
+        regions = [(rect, None) for rect in rects]
+    
+    if len(regions) < 2 or ENCODE_WORKERS == 1:
+        return [encode(region) for region in regions]
+    return list(encode_pool.map(encode, regions))
+
+def line_hashes(pixels, axis):
+    # crc32 per baris (axis 0) atau per kolom (axis 1)
+    lines = pixels if axis == 0 else pixels.transpose(1, 0, 2)
+    return np.array([zlib.crc32(line) for line in np.ascontiguousarray(lines)], dtype=np.uint32)
+
+def find_shift(current, previous):
+    # Setiap baris yang unik di frame sebelumnya memberi suara untuk geseran
+    # shift dengan current[i] == previous[i + shift]; baris berulang (latar
+    # kosong) cocok dengan geseran apa pun sehingga tidak ikut memilih
+    positions = {}
+    for index, value in enumerate(previous.tolist()):
+        positions[value] = -1 if value in positions else index
+    votes = Counter(
+        positions[value] - index
+        for index, value in enumerate(current.tolist()) if positions.get(value, -1) >= 0)
+    votes.pop(0, None)
+    if not votes:
+        return 0
+    shift, count = votes.most_common(1)[0]
+    return shift if count >= SCROLL_MIN_LINES else 0
+
+def matching_runs(current, previous, shift):
+    # Rentang [awal, akhir) yang barisnya sama dengan baris sebelumnya + shift
+    match = np.zeros(len(current) + 2, dtype=bool)
+    index = np.arange(max(0, -shift), min(len(current), len(previous) - shift))
+    match[index + 1] = current[index] == previous[index + shift]
+    edges = np.flatnonzero(match[1:] != match[:-1])
+    return [(start, end) for start, end in zip(edges[::2], edges[1::2]) if end - start >= SCROLL_MIN_LINES]
+
+def find_scroll(frame, prev_frame, tile_mask):
+    # Kembalikan (instruksi COPY, prediksi framebuffer client setelah COPY),
+    # atau ([], None). Hash dihitung hanya di kotak area yang berubah agar
+    # panel statis di sebelah area yang di-scroll tidak merusak kecocokan.
+    tile_rows = np.flatnonzero(tile_mask.any(axis=1))
+    tile_cols = np.flatnonzero(tile_mask.any(axis=0))
+    top, left = tile_rows[0] * TILE_SIZE, tile_cols[0] * TILE_SIZE
+    bottom, right = (tile_rows[-1] + 1) * TILE_SIZE, (tile_cols[-1] + 1) * TILE_SIZE
+    changed = np.any(frame[top:bottom, left:right] != prev_frame[top:bottom, left:right], axis=2)
+    rows = np.flatnonzero(changed.any(axis=1))
+    cols = np.flatnonzero(changed.any(axis=0))
+    top, bottom = top + int(rows[0]), top + int(rows[-1]) + 1
+    left, right = left + int(cols[0]), left + int(cols[-1]) + 1
+    
+    region = frame[top:bottom, left:right]
+    prev_region = prev_frame[top:bottom, left:right]
+    for axis in (0, 1):
+        current = line_hashes(region, axis)
+        previous = line_hashes(prev_region, axis)
+        shift = find_shift(current, previous)
+        if shift:
+            break
+    else:
+        return [], None
+    
+    # Client menerapkan COPY berurutan, jadi urutannya dipilih agar sumber
+    # sebuah COPY belum ditimpa COPY sebelumnya, dan prediksi dibangun
+    # dengan cara yang sama. Hash yang bertabrakan tidak berbahaya karena
+    # tile yang berbeda dari prediksi tetap dikirim.
+    runs = matching_runs(current, previous, shift)
+    if shift < 0:
+        runs.reverse()
+    predicted = prev_frame.copy()
+    copies = []
+    for start, end in runs:
+        if axis == 0:
+            x, y, w, h = left, top + int(start), right - left, int(end - start)
+            sx, sy = x, y + shift
+        else:
+            x, y, w, h = left + int(start), top, int(end - start), bottom - top
+            sx, sy = x + shift, y
+        predicted[y:y + h, x:x + w] = predicted[sy:sy + h, sx:sx + w]
+        copies.append((x, y, w, h, protocol.ENC_COPY, protocol.COPY_SOURCE.pack(sx, sy)))
+    if not copies:
+        return [], None
+    return copies, predicted
+
+def tile_key(pixels, quality, lossless):
+    # Pengaturan encode ikut di-hash agar tile berkualitas rendah tidak dipakai
+    # lagi setelah kualitas dinaikkan
+    height, width = pixels.shape[:2]
+    person = f"{quality}:{int(lossless)}:{width}x{height}".encode()
+    return hashlib.blake2b(np.ascontiguousarray(pixels), digest_size=protocol.CACHE_KEY_SIZE, person=person).digest()
+
+def encode_cell(frame, cell, quality, lossless):
+    x, y, w, h = cell
+    pixels = frame[y:y + h, x:x + w]
+    palette = classify_region(pixels) if lossless else None
+    if palette is not None:
+        return protocol.ENC_PALETTE, encode_palette(*palette)
+    return protocol.ENC_JPEG, encode_jpeg(pixels, quality)
+
+def encode_cached(frame, rects, quality, lossless, tiles):
+    # Dengan cache tile setiap sel TILE_SIZE di-encode sendiri agar isi yang
+    # muncul lagi bisa dirujuk di posisi grid mana pun. Isi yang pernah
+    # di-encode diambil dari tiles tanpa encode ulang.
+    cells = [cell for rect in rects for cell in split_cells(rect)]
+    keys = [tile_key(frame[y:y + h, x:x + w], quality, lossless) for x, y, w, h in cells]
+    results = {}
+    missing = {}
+    for cell, key in zip(cells, keys):
+        if key in results or key in missing:
+            continue
+        result = tiles.get(key)
+        if result is None:
+            missing[key] = cell
+        else:
+            results[key] = result
+    
+    def encode(cell):
+        return encode_cell(frame, cell, quality, lossless)
+    
+    parallel = len(missing) >= 2 and ENCODE_WORKERS > 1
+    encoded = encode_pool.map(encode, missing.values()) if parallel else map(encode, missing.values())
+    for key, result in zip(missing, encoded):
+        tiles.put(key, result)
+        results[key] = result
+    return [
+        (x, y, w, h, results[key][0] | protocol.CACHE_STORE, key + results[key][1])
+        for (x, y, w, h), key in zip(cells, keys)
+    ]
+
+def projection_shift(current, previous):
+    # Geseran s dengan current[i] ~ previous[i + s] dari profil rata-rata
+    # baris atau kolom, dalam rentang MOTION_RANGE. Hanya bagian tengah yang
+    # dibandingkan agar panjangnya sama untuk setiap geseran.
+    limit = min(protocol.MOTION_RANGE, (len(current) - 1) // 2)
+    middle = current[limit:len(current) - limit]
+    windows = np.lib.stride_tricks.sliding_window_view(previous, len(middle))
+    return int(np.argmin(np.abs(windows - middle).mean(axis=1))) - limit
+
+def motion_candidates(pixels, reference):
+    # Kandidat vektor satu rect: diam, geseran dominan dan tetangganya. Video
+    # yang di-pan atau di-scroll bergerak hampir seragam, jadi satu perkiraan
+    # dari proyeksi jauh lebih murah daripada pencarian penuh per blok.
+    current = pixels[..., 1]
+    previous = reference[..., 1]
+    dx = projection_shift(current.mean(axis=0), previous.mean(axis=0))
+    dy = projection_shift(current.mean(axis=1), previous.mean(axis=1))
+    vectors = []
+    for vector in ((0, 0), (dx, dy), (dx, 0), (0, dy), (dx - 1, dy), (dx + 1, dy), (dx, dy - 1), (dx, dy + 1)):
+        if vector not in vectors and max(map(abs, vector)) <= protocol.MOTION_RANGE:
+            vectors.append(vector)
+    return vectors
+
+def match_blocks(pixels, padded, vectors):
+    # Indeks vektor dengan SAD terkecil per blok; kanal hijau dengan setiap
+    # piksel kedua sudah cukup untuk memilih
+    height, width = pixels.shape[:2]
+    block, offset = protocol.MOTION_BLOCK, protocol.MOTION_RANGE
+    rows, cols = -(-height // block), -(-width // block)
+    # Blok terakhir yang terpotong diperpanjang tepinya seperti referensi
+    target = np.pad(pixels[..., 1], ((0, rows * block - height), (0, cols * block - width)), mode="edge")
+    target = target[::2, ::2].astype(np.int16)
+    best = indices = None
+    for index, (dx, dy) in enumerate(vectors):
+        candidate = padded[offset + dy:offset + dy + rows * block:2, offset + dx:offset + dx + cols * block:2, 1]
+        sad = np.abs(candidate - target).reshape(rows, block // 2, cols, block // 2).sum(axis=(1, 3))
+        if best is None:
+            best, indices = sad, np.zeros((rows, cols), dtype=np.uint8)
+        else:
+            better = sad < best
+            best[better] = sad[better]
+            indices[better] = index
+    return indices
+
+class BlockMotionCodec:
+    # Kodek temporal NumPy (lihat protocol.ENC_MOTION). reference adalah
+    # cermin referensi client; known menandai tile yang sudah diisi INTRA
+    # sejak reset terakhir dan boleh dirujuk INTER. Setiap rect juga di-encode
+    # sebagai JPEG INTRA dan yang lebih kecil yang dikirim, jadi konten yang
+    # tidak cocok diprediksi tidak pernah lebih boros dari JPEG biasa.
+    name = "block"
+    
+    def __init__(self):
+        self.reference = None
+        self.known = None
+    
+    def reset(self):
+        # Dipanggil setiap keyframe: client yang mulai dari keyframe itu belum
+        # punya referensi apa pun
+        self.reference = None
+    
+    def encode(self, frame, rects, quality):
+        height, width = frame.shape[:2]
+        if self.reference is None or self.reference.shape != frame.shape:
+            self.reference = np.zeros_like(frame)
+            self.known = np.zeros((-(-height // TILE_SIZE), -(-width // TILE_SIZE)), dtype=bool)
+        
+        def encode(rect):
+            return self.encode_rect(frame, rect, quality)
+        
+        # Rect tidak bertumpuk dan hanya membaca referensinya sendiri
+        if len(rects) < 2 or ENCODE_WORKERS == 1:
+            return [encode(rect) for rect in rects]
+        return list(encode_pool.map(encode, rects))
+    
+    def encode_rect(self, frame, rect, quality):
+        x, y, w, h = rect
+        pixels = frame[y:y + h, x:x + w]
+        tiles = (slice(y // TILE_SIZE, -(-(y + h) // TILE_SIZE)), slice(x // TILE_SIZE, -(-(x + w) // TILE_SIZE)))
+        intra = encode_jpeg(pixels, quality)
+        if self.known[tiles].all():
+            padded = protocol.pad_reference(self.reference, rect)
+            vectors = motion_candidates(pixels, self.reference[y:y + h, x:x + w])
+            indices = match_blocks(pixels, padded, vectors)
+            prediction = protocol.predict_motion(padded, w, h, vectors, indices)
+            residual = np.clip(pixels.astype(np.int16) - prediction + 128, 0, 255).astype(np.uint8)
+            image = encode_jpeg(residual, quality)
+            if len(image) < len(intra):
+                self.reference[y:y + h, x:x + w] = protocol.apply_residual(prediction, decode_jpeg(image))
+                data = protocol.pack_motion(protocol.MOTION_INTER, image, vectors, indices)
+                return (x, y, w, h, protocol.ENC_MOTION, data)
+        self.reference[y:y + h, x:x + w] = decode_jpeg(intra)
+        self.known[tiles] = True
+        return (x, y, w, h, protocol.ENC_MOTION, protocol.pack_motion(protocol.MOTION_INTRA, intra))
+
+MOTION_CODECS = {BlockMotionCodec.name: BlockMotionCodec}
+
+def encode_motion(frame, rects, quality, lossless, codec):
+    # Tile teks/UI di area yang bergerak tetap palet lossless seperti di
+    # encode_rects; hanya run JPEG yang masuk kodek temporal
+    if lossless:
+        regions = [region for rect in rects for region in plan_rect(frame, rect)]
+    else:
+        regions = [(rect, None) for rect in rects]
+    palettes = [(x, y, w, h, protocol.ENC_PALETTE, encode_palette(*palette))
+                for (x, y, w, h), palette in regions if palette is not None]
+    return palettes + codec.encode(frame, [rect for rect, palette in regions if palette is None], quality)
+
+def encode_frame(frame, prev_frame, quality, lossless=False, scroll=False, tiles=None, motion=None, codec=None):
+    # Kembalikan (rect, mask tile yang berubah); mask None untuk frame penuh.
+    # motion adalah mask frame sebelumnya: tile yang berubah dua frame
+    # berturut-turut (video, animasi) dikirim lewat kodek temporal bila ada.
+    # Dengan cache tile isinya jarang muncul lagi, jadi tanpa kodek tetap
+    # dikirim sebagai run JPEG tanpa kunci agar tidak membayar header per sel.
+    height, width = frame.shape[:2]
+    copies = []
+    tile_mask = None
+    if prev_frame is None or prev_frame.shape != frame.shape:
+        rects = stripe_rects(width, height)
+    else:
+        tile_mask = find_dirty_tiles(frame, prev_frame)
+        if scroll and tile_mask.sum() >= SCROLL_MIN_TILES:
+            copies, predicted = find_scroll(frame, prev_frame, tile_mask)
+            if copies:
+                tile_mask = find_dirty_tiles(frame, predicted)
+        rects = dirty_rects(tile_mask, width, height)
+    
+    if tiles is None and codec is None:
+        return copies + encode_rects(frame, rects, quality, lossless), tile_mask
+    if tile_mask is None or motion is None or motion.shape != tile_mask.shape:
+        if tiles is None:
+            return copies + encode_rects(frame, rects, quality, lossless), tile_mask
+        return copies + encode_cached(frame, rects, quality, lossless, tiles), tile_mask
+    
+    hot = tile_mask & motion
+    hot_rects = dirty_rects(hot, width, height)
+    if codec is None:
+        moving = encode_rects(frame, hot_rects, quality, lossless)
+    else:
+        moving = encode_motion(frame, hot_rects, quality, lossless, codec)
+    rects = dirty_rects(tile_mask & ~hot, width, height)
+    if tiles is None:
+        return copies + moving + encode_rects(frame, rects, quality, lossless), tile_mask
+    return copies + moving + encode_cached(frame, rects, quality, lossless, tiles), tile_mask
+
+def is_full_frame(rects, width, height):
+    return len(rects) == 1 and rects[0][:5] == (0, 0, width, height, protocol.ENC_JPEG)
+
+def covers(outer, inner):
+    ox, oy, ow, oh = outer[:4]
+    ix, iy, iw, ih = inner[:4]
+    return ox <= ix and oy <= iy and ix + iw <= ox + ow and iy + ih <= oy + oh
+
+def merge_update(update, rects, width, height):
+    # Gabungkan delta baru ke update yang belum terkirim; rect lama yang
+    # tertutup penuh oleh rect baru tidak perlu dikirim lagi. COPY membaca
+    # framebuffer client, jadi rect yang masih bisa terbaca oleh COPY
+    # (di update baru, atau setelahnya di update lama) tetap dikirim. Rect
+    # MOTION juga mengisi referensi kodek temporal client sehingga tidak
+    # pernah dibuang walau tampilannya tertutup; FrameHub.publish membatasi
+    # panjang hasilnya dengan snapshot hub.
+    if update is None or update[1:] != (width, height) or protocol.covers_frame(rects, width, height):
+        return (rects, width, height)
+    if any(rect[4] == protocol.ENC_COPY for rect in rects):
+        return (update[0] + rects, width, height)
+    
+    old_rects = update[0]
+    barrier = max((index for index, old in enumerate(old_rects) if old[4] == protocol.ENC_COPY), default=0)
+    kept = old_rects[:barrier] + [
+        old for old in old_rects[barrier:]
+        if old[4] == protocol.ENC_MOTION or not any(covers(new, old) for new in rects)]
+    return (kept + rects, width, height)
+
+class FrameSubscription:
+    def __init__(self, pending, ready, seq=0, captured=0):
+        self.pending = pending
+        self.since = time.perf_counter()
+        # Nomor dan waktu capture (mikrodetik, jam monotonic server) dari
+        # capture terbaru yang sudah tergabung di pending
+        self.seq = seq
+        self.captured = captured
+        self.dropped = 0
+        self.ready = ready
+        if pending is not None:
+            self.ready.set()
+
+class FrameHub:
+    # Satu stream hasil encode untuk semua viewer dengan viewport yang sama.
+    # Hanya dipakai dari event loop, jadi tidak perlu lock.
+    def __init__(self, viewport=None, full_frames=False):
+        self.viewport = viewport
+        self.full_frames = full_frames  # setiap update satu JPEG utuh, untuk client tanpa CAPS
+        self.encoder = None  # dibuat capture_loop saat hub pertama kali ditonton
+        self.subscribers = set()
+        self.snapshot = None
+        self.keyframe_requested = False
+        self.seq = 0
+        self.captured = 0
+    
+    def subscribe(self, ready):
+        # Viewer baru langsung mendapat state layar terakhir tanpa encode ulang
+        subscription = FrameSubscription(self.snapshot, ready, self.seq, self.captured)
+        self.subscribers.add(subscription)
+        return subscription
+    
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+    
+    def publish(self, rects, width, height, keyframe=None, captured=0):
+        tiles = -(-width // TILE_SIZE) * -(-height // TILE_SIZE)
+        if keyframe is not None or protocol.covers_frame(rects, width, height):
+            self.snapshot = (keyframe or rects, width, height)
+            self.keyframe_requested = False
+        else:
+            self.snapshot = merge_update(self.snapshot, rects, width, height)
+            if len(self.snapshot[0]) > tiles:
+                self.keyframe_requested = True
+        
+        if not rects:
+            return
+        self.seq += 1
+        self.captured = captured
+        for subscription in self.subscribers:
+            if subscription.pending is not None:
+                subscription.dropped += 1
             else:
-                logging.error(f"Semua percobaan pengiriman gagal: {e}")
-                return False
-    return False
+                subscription.since = time.perf_counter()
+            subscription.seq = self.seq
+            subscription.captured = captured
+            subscription.pending = merge_update(subscription.pending, rects, width, height)
+            if len(subscription.pending[0]) > tiles:
+                # Rect COPY (beserta yang terbaca olehnya) dan MOTION tidak bisa
+                # dipangkas, jadi viewer yang tertinggal menerima snapshot hub
+                # (mencakup seluruh layar, rantai MOTION-nya dimulai dari reset
+                # kodek) agar antreannya tidak terus tumbuh
+                subscription.pending = self.snapshot
+            subscription.ready.set()
+    
+    def take(self, subscription):
+        update = subscription.pending
+        subscription.pending = None
+        return update
+
+class ViewportHubs:
+    # FrameHub per viewport (None = layar penuh dengan SCREEN_SCALE untuk
+    # client tanpa VIEWPORT). Hub viewport yang tidak lagi ditonton dibuang
+    # bersama encodernya. Client lama yang tidak mengirim CAPS hanya bisa
+    # men-decode JPEG utuh di header QII, jadi mendapat hub LEGACY sendiri.
+    LEGACY = "legacy"
+    
+    def __init__(self):
+        self.hubs = {None: FrameHub()}
+        self.watched = asyncio.Event()  # di-set selama ada minimal satu viewer
+    
+    def subscribe(self, viewport, ready, full_frames=False):
+        key = self.LEGACY if full_frames else viewport
+        hub = self.hubs.get(key)
+        if hub is None:
+            hub = self.hubs[key] = FrameHub(None if full_frames else viewport, full_frames)
+        subscription = hub.subscribe(ready)
+        self.watched.set()
+        logging.info(f"Jumlah viewer: {self.viewers()} ({len(self.active())} viewport)")
+        return hub, subscription
+    
+    def unsubscribe(self, hub, subscription):
+        hub.unsubscribe(subscription)
+        if not hub.subscribers and (hub.viewport is not None or hub.full_frames):
+            self.hubs.pop(self.LEGACY if hub.full_frames else hub.viewport, None)
+        if not self.viewers():
+            self.watched.clear()
+        logging.info(f"Jumlah viewer: {self.viewers()} ({len(self.active())} viewport)")
+    
+    def viewers(self):
+        return sum(len(hub.subscribers) for hub in self.hubs.values())
+    
+    def active(self):
+        return [hub for hub in self.hubs.values() if hub.subscribers]
+
+frame_hubs = ViewportHubs()
 
-def screenshot_worker():
-    screen_width, screen_height = pyautogui.size()
-    target_width = int(screen_width * SCREEN_SCALE)
-    target_height = int(screen_height * SCREEN_SCALE)
+def grab_screen():
+    # Satu grab per tick dipakai bersama oleh encoder semua viewport
+    captured = time.monotonic_ns() // 1000
+    with stage_timings.measure("capture"):
+        frame = capture_source.grab()
+        # crc32 layar mentah (~2 ms untuk 1080p) jauh lebih murah daripada
+        # resize dan perbandingan tile, jadi frame yang identik berhenti di sini
+        frame_hash = zlib.crc32(np.ascontiguousarray(frame))
+    return frame, frame_hash, captured
+
+class ScreenEncoder:
+    # viewport (lebar, tinggi, x, y, w, h): region layar (x, y, w, h) di-encode
+    # seukuran jendela client, tidak lebih besar dari region itu sendiri.
+    # Tanpa viewport seluruh layar diskalakan dengan SCREEN_SCALE.
+    def __init__(self, source, viewport=None, full_frames=False):
+        self.source = source
+        self.full_frames = full_frames
+        self.screen_width, self.screen_height = source.size()
+        self.viewport = viewport
+        self.region = (0, 0, self.screen_width, self.screen_height) if viewport is None else viewport[2:]
+        self.prev_frame = None
+        self.frame_hash = None
+        self.unchanged = 0
+        self.lossless = False
+        self.scroll = False
+        self.tiles = None  # hasil encode per kunci tile selama cache tile aktif
+        self.motion = None  # mask tile yang berubah di frame sebelumnya
+        self.codec = None   # kodek temporal selama semua viewer mendukung MOTION
+        self.width = self.height = None
+        self.configure(QUALITY, SCREEN_SCALE)
+    
+    def configure(self, quality, scale):
+        if self.viewport is None:
+            width = int(self.screen_width * scale)
+            height = int(self.screen_height * scale)
+        else:
+            # Level RateController di bawah SCREEN_SCALE memperkecil viewport
+            # dengan perbandingan yang sama
+            window_width, window_height, _, _, region_width, region_height = self.viewport
+            factor = min(1.0, scale / SCREEN_SCALE)
+            width = max(1, int(min(window_width, region_width) * factor))
+            height = max(1, int(min(window_height, region_height) * factor))
+        if (width, height) != (self.width, self.height):
+            self.frame_hash = None
+        self.quality = quality
+        self.width = width
+        self.height = height
     
-    last_capture_time = 0
-    min_interval = 1.0 / FPS_LIMIT  
+    def refresh(self):
+        # Frame berikutnya dikirim penuh, misalnya setelah kualitas dinaikkan
+        self.prev_frame = None
+    
+    def set_features(self, lossless, scroll, cache=False, motion=False):
+        # Saat viewer tanpa dukungan palet, COPY atau MOTION bergabung, tile
+        # tersebut di layarnya diganti keyframe JPEG penuh. Tile cache tidak
+        # perlu: ClientOutbox melepas kuncinya untuk client tanpa cache.
+        if (self.lossless and not lossless) or (self.scroll and not scroll) or (self.codec is not None and not motion):
+            self.refresh()
+        self.lossless = lossless
+        self.scroll = scroll
+        if not cache:
+            self.tiles = None
+        elif self.tiles is None:
+            self.tiles = protocol.TileCache(TILE_CACHE_ENTRIES)
+        if not motion:
+            self.codec = None
+        elif self.codec is None:
+            self.codec = MOTION_CODECS[MOTION_CODEC]()
+    
+    def scale_frame(self, frame):
+        x, y, w, h = self.region
+        frame = frame[y:y + h, x:x + w]
+        if (w, h) == (self.width, self.height):
+            # Backend memakai ulang buffernya, sedangkan prev_frame bisa bertahan
+            # beberapa grab saat frame identik dilewati
+            return frame.copy()
+        return np.asarray(Image.fromarray(frame).resize((self.width, self.height)))
+    
+    def encode(self, frame, frame_hash, keyframe_requested):
+        if frame_hash == self.frame_hash and self.prev_frame is not None:
+            self.unchanged += 1
+            self.motion = None
+            return [], None
+        self.frame_hash = frame_hash
+        
+        with stage_timings.measure("resize"):
+            frame = self.scale_frame(frame)
+        prev_frame = self.prev_frame
+        self.prev_frame = frame
+        
+        with stage_timings.measure("encode"):
+            if self.full_frames:
+                # Seperti server sebelum delta: satu JPEG per frame yang berubah
+                return [(0, 0, self.width, self.height, protocol.ENC_JPEG, encode_jpeg(frame, self.quality))], None
+            keyframe = None
+            if not DELTA_MODE or prev_frame is None or prev_frame.shape != frame.shape:
+                rects, self.motion = encode_frame(frame, None, self.quality, self.lossless, tiles=self.tiles)
+            else:
+                rects, self.motion = encode_frame(
+                    frame, prev_frame, self.quality, self.lossless, self.scroll, self.tiles, self.motion, self.codec)
+                if keyframe_requested:
+                    keyframe, _ = encode_frame(frame, None, self.quality, self.lossless, tiles=self.tiles)
+            # Viewer yang mulai dari keyframe (snapshot hub) tidak menerima rect
+            # MOTION sebelumnya, jadi referensi kodek ikut dimulai dari awal
+            if self.codec is not None and (
+                    keyframe is not None or protocol.covers_frame(rects, self.width, self.height)):
+                self.codec.reset()
+            return rects, keyframe
 
-    logging.info(f"Screenshot worker dimulai: {target_width}x{target_height} @ {FPS_LIMIT} FPS")
+class RateController:
+    # AIMD sederhana di atas QUALITY_LEVELS: turun dua level saat ada viewer
+    # yang tertekan, naik satu level setelah beberapa interval sehat. Karena
+    # hasil encode dibagi ke semua viewer, viewer paling lambat yang menentukan.
+    def __init__(self):
+        self.level = QUALITY_LEVELS.index((QUALITY, SCREEN_SCALE, FPS_LIMIT))
+        self.healthy_intervals = 0
+    
+    def settings(self):
+        return QUALITY_LEVELS[self.level]
+    
+    def update(self, outboxes):
+        reasons = [reason for reason in (outbox.congestion() for outbox in outboxes) if reason]
+        previous = self.level
+        
+        if reasons:
+            self.level = min(len(QUALITY_LEVELS) - 1, self.level + 2)
+            self.healthy_intervals = 0
+        else:
+            self.healthy_intervals += 1
+            if self.healthy_intervals >= 3 and self.level > 0:
+                self.level -= 1
+                self.healthy_intervals = 0
+        
+        if self.level != previous:
+            quality, scale, fps = self.settings()
+            cause = reasons[0] if reasons else "koneksi sehat"
+            logging.info(f"Kualitas adaptif: {quality}% x{scale} @ {fps} FPS ({cause})")
+        return self.level < previous
 
+async def capture_loop(executor):
+    loop = asyncio.get_running_loop()
+    controller = RateController()
+    quality, scale, fps_limit = QUALITY, SCREEN_SCALE, FPS_LIMIT
+    last_control_time = loop.time()
+    
+    width, height = capture_source.size()
+    logging.info(
+        f"Screenshot worker dimulai ({capture_source.name}): "
+        f"{int(width * scale)}x{int(height * scale)} @ {FPS_LIMIT} FPS")
+    
     while not stop_event.is_set():
-        current_time = time.time()
-        if current_time - last_capture_time >= min_interval:
-            try:
-                screenshot = pyautogui.screenshot()
-                
-                if SCREEN_SCALE != 1.0:
-                    screenshot = screenshot.resize((target_width, target_height))
+        if not frame_hubs.watched.is_set():
+            # Tanpa viewer tidak ada yang di-capture maupun di-encode
+            unchanged = sum(hub.encoder.unchanged for hub in frame_hubs.hubs.values() if hub.encoder)
+            logging.info(f"Tidak ada viewer, capture dijeda ({unchanged} frame tanpa perubahan dilewati)")
+            await frame_hubs.watched.wait()
+            logging.info("Viewer terhubung, capture dilanjutkan")
+            continue
+        
+        start_time = loop.time()
+        
+        refresh = False
+        if ADAPTIVE_QUALITY and start_time - last_control_time >= CONTROL_INTERVAL:
+            last_control_time = start_time
+            for outbox in active_outboxes:
+                outbox.send_ping()
+            refresh = controller.update(active_outboxes)
+            quality, scale, fps_limit = controller.settings()
+        
+        try:
+            frame, frame_hash, captured = await loop.run_in_executor(executor, grab_screen)
+            for hub in frame_hubs.active():
+                if hub.encoder is None:
+                    hub.encoder = ScreenEncoder(capture_source, hub.viewport, hub.full_frames)
+                encoder = hub.encoder
+                if refresh:
+                    encoder.refresh()
+                encoder.configure(quality, scale)
                 
-                img_bytes = io.BytesIO()
-                screenshot.save(img_bytes, format="JPEG", quality=QUALITY)
-                img_data = img_bytes.getvalue()
+                viewers = [outbox for outbox in active_outboxes.union(parked_sessions.values()) if outbox.hub is hub]
+                # Rekaman menyimpan rect apa adanya (tile cache tetap membawa
+                # datanya), jadi recorder tidak membatasi fitur encoder
+                watched = bool(viewers) or (session_recorder is not None and session_recorder.hub is hub)
+                encoder.set_features(
+                    CONTENT_AWARE and watched and all(outbox.palette for outbox in viewers),
+                    SCROLL_DETECTION and watched and all(outbox.copy_rect for outbox in viewers),
+                    TILE_CACHE_ENTRIES > 0 and watched and all(outbox.tile_cache is not None for outbox in viewers),
+                    MOTION_CODEC in MOTION_CODECS and watched and all(outbox.motion_codec for outbox in viewers))
                 
-                try:
-                    if not screenshot_queue.full():
-                        screenshot_queue.put_nowait((img_data, target_width, target_height))
-                    else:
-                        try:
-                            screenshot_queue.get_nowait() 
-                            screenshot_queue.put_nowait((img_data, target_width, target_height))
-                        except queue.Empty:
-                            pass
-                except Exception as e:
-                    logging.error(f"Error pada antrian screenshot: {e}")
-                    
-                last_capture_time = current_time
-            except Exception as e:
-                logging.error(f"Error saat mengambil screenshot: {e}")
+                rects, keyframe = await loop.run_in_executor(
+                    executor, encoder.encode, frame, frame_hash, hub.keyframe_requested)
+                hub.publish(rects, encoder.width, encoder.height, keyframe, captured)
+        except Exception as e:
+            logging.error(f"Error saat mengambil screenshot: {e}")
         
-        time.sleep(0.005)
+        await asyncio.sleep(max(0.0, 1.0 / fps_limit - (loop.time() - start_time)))
 
-def handle_client(conn, addr):
-    logging.info(f"Koneksi dari {addr}")
+def read_cursor():
+    position = capture_source.cursor()
+    if position is None and cursor_controller is not None:
+        position = cursor_controller.position
+    return position
+
+async def cursor_loop():
+    # Posisi kursor dibaca jauh lebih sering daripada frame dan dikirim sebagai
+    # pesan kecil tersendiri, sehingga gerakan pointer di client tidak menunggu
+    # pipeline capture/encode
+    global cursor_position
+    
+    while not stop_event.is_set():
+        await frame_hubs.watched.wait()
+        try:
+            position = read_cursor()
+        except Exception as e:
+            logging.error(f"Error saat membaca posisi kursor, kanal kursor dihentikan: {e}")
+            return
+        
+        if position is not None and position != cursor_position:
+            cursor_position = position
+            for outbox in active_outboxes:
+                outbox.send_cursor(position)
+            if session_recorder is not None:
+                session_recorder.record_cursor(position)
+        await asyncio.sleep(1.0 / CURSOR_RATE)
+
+class SessionRecorder:
+    # Menyalin update FrameHub layar penuh ke file rekaman tanpa encode ulang.
+    # Seperti viewer biasa, update digabung di FrameSubscription selama disk
+    # tertinggal, jadi rekaman tidak pernah menahan viewer lain. Semua record
+    # ditulis oleh satu thread agar urutannya terjaga.
+    def __init__(self, path):
+        width, height = capture_source.size()
+        self.writer = recording.RecordingWriter(path, width, height)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recording")
+        self.start = time.monotonic_ns() // 1000
+        self.wake = asyncio.Event()
+        self.hub = None
+        self.subscription = None
+        self.last_keyframe = None
+    
+    def elapsed(self, timestamp=None):
+        return (time.monotonic_ns() // 1000 if timestamp is None else timestamp) - self.start
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.hub, self.subscription = frame_hubs.subscribe(None, self.wake)
+        logging.info(f"Merekam sesi ke {self.writer.path}")
+        
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            update = self.hub.take(self.subscription)
+            if update is None:
+                continue
+            
+            flags = 0
+            if update is self.hub.snapshot:
+                # Antrean yang diganti snapshot oleh publish juga titik seek
+                flags = protocol.FLAG_KEYFRAME
+                self.last_keyframe = loop.time()
+            elif self.last_keyframe is None or loop.time() - self.last_keyframe >= RECORD_KEYFRAME_INTERVAL:
+                # Snapshot hub sudah mencakup update ini dan bisa diputar dari layar kosong
+                update, flags = self.hub.snapshot, protocol.FLAG_KEYFRAME
+                self.last_keyframe = loop.time()
+            rects, width, height = update
+            await loop.run_in_executor(
+                self.executor, self.writer.write_update,
+                rects, width, height, self.elapsed(self.subscription.captured), flags)
     
-    mouse = MouseController()
-    keyboard = KeyboardController()
+    def record(self, kind, payload):
+        self.executor.submit(self.writer.write, kind, self.elapsed(), payload)
     
-    screen_width, screen_height = pyautogui.size()
-    logging.info(f"Ukuran layar: {screen_width}x{screen_height}")
+    def record_input(self, addr, cmd_type, args):
+        event = {"addr": f"{addr[0]}:{addr[1]}", "cmd": cmd_type, "args": args}
+        self.record(recording.RECORD_INPUT, json.dumps(event).encode())
     
-    config_data = f"CONFIG {screen_width} {screen_height}\n"
-    if not safe_send(conn, config_data.encode()):
-        logging.error("Gagal mengirim konfigurasi ke client")
-        return
+    def record_cursor(self, position):
+        x, y = position
+        self.record(recording.RECORD_CURSOR, protocol.CURSOR_PAYLOAD.pack(int(x), int(y), 1))
     
-    command_buffer = ""
+    def close(self):
+        self.executor.submit(self.writer.close)
+        self.executor.shutdown(wait=True)
+        logging.info(f"Rekaman {self.writer.path} ditutup: {self.writer.records} record, "
+                     f"{len(self.writer.index)} keyframe, {self.writer.offset / 1e6:.1f} MB")
+
+active_outboxes = set()
+parked_sessions = {}  # token -> ClientOutbox yang koneksinya putus, selama SESSION_GRACE
+
+class ClientOutbox:
+    # Antrian keluar per client: pesan kontrol langsung masuk buffer transport,
+    # frame hanya ditulis saat buffer cukup kosong. Selama tertahan, frame baru
+    # menggantikan yang lama di FrameSubscription sehingga client selalu
+    # menerima state terbaru. Dengan CAPS CHANNELS semua pesan masuk antrian
+    # per kanal dan pump() mengirimnya per chunk menurut prioritas kanal.
+    def __init__(self, writer, addr):
+        self.writer = writer
+        self.addr = addr
+        self.wake = asyncio.Event()
+        self.viewport = None    # (lebar, tinggi, x, y, w, h) dari perintah VIEWPORT
+        self.hub = None
+        self.subscription = None
+        self.seq_offset = 0     # menjaga nomor urut tetap berlanjut saat pindah hub
+        self.legacy = True      # belum mengirim CAPS: hanya menerima JPEG utuh
+        self.header_v2 = False  # aktif setelah client mengirim CAPS FRAME_V2
+        self.cursor = False     # CAPS CURSOR: posisi kursor dikirim sebagai FRAME_CURSOR
+        self.palette = False    # CAPS PALETTE: client bisa men-decode tile ENC_PALETTE
+        self.copy_rect = False  # CAPS COPYRECT: client bisa menerapkan instruksi ENC_COPY
+        self.motion_codec = False  # CAPS MOTION: client bisa men-decode rect ENC_MOTION
+        self.tile_cache = None  # cermin cache tile client setelah perintah CACHE
+        self.channels = False   # CAPS CHANNELS: pesan dikirim per chunk lewat kanal
+        self.queues = [deque() for _ in protocol.CHANNELS]
+        self.offsets = [0] * len(protocol.CHANNELS)
+        self.queued = 0         # byte di antrian kanal yang belum masuk buffer transport
+        self.sending = asyncio.Event()
+        self.greeted = asyncio.Event()  # perintah pertama client sudah diproses
+        self.token = None       # token sesi untuk client CAPS RESUME
+        self.sent_log = deque() # (seq, pesan) frame terkirim setelah ACK terakhir
+        self.log_bytes = 0
+        self.log_floor = -1     # seq terakhir yang tidak lagi ada di sent_log
+        self.resume_seq = None  # seq terakhir di client saat sesi dilanjutkan
+        self.expiry = None
+        self.task = None        # task run() milik koneksi yang sedang memegang outbox
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.peak_backlog = 0
+        writer.transport.set_write_buffer_limits(high=OUTBOX_HIGH_WATER)
+        
+        # Umpan balik untuk RateController; aktif setelah client mengirim STATS
+        self.adaptive = False
+        self.rtt_ms = 0.0
+        self.client_fps = 0.0
+        self.client_kbps = 0.0
+        self.client_latency_ms = None
+        self.client_dropped = 0
+        self.window_frames = 0
+        self.window_dropped = 0
+        self.window_backlog = 0
+        self.window_start = time.time()
     
-    conn.settimeout(RECV_TIMEOUT)
+    def backlog(self):
+        return self.writer.transport.get_write_buffer_size() + self.queued
     
-    key_states = {}
+    def send_control(self, data, channel=protocol.CHANNEL_CONTROL):
+        if self.writer.is_closing():
+            return
+        if not self.channels:
+            self.writer.write(data)
+            return
+        self.queues[channel].append(memoryview(data))
+        self.queued += len(data)
+        self.sending.set()
     
-    last_frame_time = 0
-    min_frame_interval = 1.0 / FPS_LIMIT
-    frame_counter = 0
-    last_fps_report = time.time()
+    def write_chunk(self):
+        channel = next(channel for channel in protocol.CHANNELS if self.queues[channel])
+        message = self.queues[channel][0]
+        offset = self.offsets[channel]
+        chunk = message[offset:offset + protocol.CHUNK_SIZE]
+        offset += len(chunk)
+        last = offset == len(message)
+        self.writer.writelines((protocol.pack_chunk(channel, len(chunk), last), chunk))
+        self.queued -= len(chunk)
+        if not last:
+            self.offsets[channel] = offset
+            return
+        self.queues[channel].popleft()
+        self.offsets[channel] = 0
+        if channel == protocol.CHANNEL_FRAMES:
+            # Frame berikutnya baru diambil dari FrameSubscription sekarang
+            self.wake.set()
     
-    last_activity_time = time.time()
-    connection_active = True
+    async def pump(self):
+        # Buffer transport dibatasi sekitar dua chunk, jadi pesan kontrol yang
+        # baru masuk hanya menunggu chunk yang sedang berjalan, bukan sisa frame
+        while True:
+            await self.sending.wait()
+            self.sending.clear()
+            while self.queued:
+                await self.writer.drain()
+                self.write_chunk()
     
-    try:
-        while connection_active and not stop_event.is_set():
-            current_time = time.time()
+    def header(self, frame_type, length, width=0, height=0, seq=0, captured=0, flags=0):
+        if not self.header_v2:
+            return struct.pack("QII", length, width, height)
+        return protocol.pack_header(frame_type, length, width, height, seq, captured, flags)
+    
+    def send_message(self, frame_type, payload):
+        self.send_control(self.header(frame_type, len(payload)) + payload)
+    
+    def cache_rects(self, rects):
+        # Tile yang sudah ada di cache client diganti rujukan kuncinya; client
+        # tanpa cache menerima tile biasa tanpa kunci
+        result = []
+        for x, y, w, h, encoding, data in rects:
+            if encoding & protocol.CACHE_STORE:
+                key = data[:protocol.CACHE_KEY_SIZE]
+                if self.tile_cache is None:
+                    encoding, data = encoding & ~protocol.CACHE_STORE, data[protocol.CACHE_KEY_SIZE:]
+                elif self.tile_cache.get(key):
+                    encoding, data = protocol.ENC_CACHE, key
+                else:
+                    self.tile_cache.put(key, True)
+            result.append((x, y, w, h, encoding, data))
+        return result
+    
+    def write_frame(self, update):
+        start = time.perf_counter()
+        rects, width, height = update
+        
+        if is_full_frame(rects, width, height):
+            img_data = rects[0][5]
+            frame_type, flags = protocol.FRAME_IMAGE, protocol.FLAG_KEYFRAME
+        else:
+            rects = self.cache_rects(rects)
+            img_data = protocol.pack_rects(rects)
+            frame_type = protocol.FRAME_RECTS
+            flags = protocol.FLAG_KEYFRAME if protocol.covers_frame(rects, width, height) else 0
+        
+        seq = self.frame_seq()
+        message = self.header(frame_type, len(img_data), width, height, seq, self.subscription.captured, flags) + img_data
+        self.send_control(message, protocol.CHANNEL_FRAMES)
+        if self.token is not None:
+            self.log_frame(seq, message)
+        stage_timings.record("send", time.perf_counter() - start)
+        self.frames_sent += 1
+        self.bytes_sent += len(img_data)
+        self.peak_backlog = max(self.peak_backlog, self.backlog())
+        self.window_frames += 1
+        self.window_backlog = max(self.window_backlog, self.backlog())
+    
+    def log_frame(self, seq, message):
+        # Frame yang mungkin hilang di jalan saat koneksi putus; dikirim ulang
+        # persis sama saat resume agar framebuffer dan cache tile client
+        # melewati urutan yang sama dengan cerminnya di server
+        self.sent_log.append((seq, message))
+        self.log_bytes += len(message)
+        while self.log_bytes > SESSION_LOG_BYTES:
+            self.log_floor, message = self.sent_log.popleft()
+            self.log_bytes -= len(message)
+    
+    def on_ack(self, args):
+        try:
+            seq = int(args)
+        except ValueError:
+            return
+        while self.sent_log and self.sent_log[0][0] <= seq:
+            _, message = self.sent_log.popleft()
+            self.log_bytes -= len(message)
+        self.log_floor = max(self.log_floor, seq)
+    
+    def send_session(self, resumed):
+        payload = protocol.SESSION_PAYLOAD.pack(self.token, int(resumed))
+        self.send_control(self.header(protocol.FRAME_SESSION, len(payload)) + payload)
+    
+    def attach(self, writer, addr, seq):
+        # Lanjutkan sesi yang di-park dengan koneksi baru; False bila frame
+        # setelah seq client sudah tidak lengkap di sent_log
+        if seq < self.log_floor:
+            return False
+        self.writer = writer
+        self.addr = addr
+        self.queues = [deque() for _ in protocol.CHANNELS]
+        self.offsets = [0] * len(protocol.CHANNELS)
+        self.queued = 0
+        self.channels = False  # diaktifkan lagi oleh CAPS di koneksi baru
+        self.resume_seq = seq
+        writer.transport.set_write_buffer_limits(high=OUTBOX_HIGH_WATER)
+        self.send_session(True)
+        self.greeted.set()
+        return True
+    
+    def resend(self):
+        resent = [message for seq, message in self.sent_log if seq > self.resume_seq]
+        for message in resent:
+            self.send_control(message, protocol.CHANNEL_FRAMES)
+        logging.info(f"Sesi {self.addr} dilanjutkan dari seq {self.resume_seq}: "
+                     f"{len(resent)} frame dikirim ulang, {sum(map(len, resent))} byte")
+        self.resume_seq = None
+    
+    def set_capabilities(self, caps):
+        self.header_v2 = protocol.CAP_FRAME_HEADER in caps
+        if self.legacy:
+            self.legacy = False
+            # CAPS datang setelah HANDSHAKE_TIMEOUT: pindah dari hub LEGACY
+            if self.subscription is not None:
+                self.subscribe()
+        self.cursor = self.header_v2 and protocol.CAP_CURSOR in caps
+        self.palette = protocol.CAP_PALETTE in caps
+        self.copy_rect = protocol.CAP_COPY_RECT in caps
+        self.motion_codec = protocol.CAP_MOTION in caps
+        if self.header_v2 and protocol.CAP_CHANNELS in caps and not self.channels:
+            self.channels = True
+            self.writer.transport.set_write_buffer_limits(high=2 * protocol.CHUNK_SIZE, low=protocol.CHUNK_SIZE)
+        if self.header_v2 and protocol.CAP_RESUME in caps and self.token is None:
+            self.token = secrets.token_bytes(protocol.SESSION_TOKEN_SIZE)
+            self.send_session(False)
+        if self.cursor and cursor_position is not None:
+            self.send_cursor(cursor_position)
+    
+    def frame_seq(self):
+        return self.subscription.seq + self.seq_offset
+    
+    def subscribe(self):
+        # Pindah ke FrameHub milik viewport saat ini; viewer langsung menerima
+        # snapshot hub itu, atau keyframe berikutnya bila hub masih baru
+        previous, previous_hub = self.subscription, self.hub
+        self.hub, self.subscription = frame_hubs.subscribe(self.viewport, self.wake, self.legacy)
+        if previous is not None:
+            self.subscription.dropped = previous.dropped
+            # Snapshot hub baru adalah frame setelah frame terakhir hub lama;
+            # nomornya tidak boleh sama karena ACK dan resume memakai seq
+            self.seq_offset += previous.seq - self.subscription.seq + (self.subscription.pending is not None)
+            frame_hubs.unsubscribe(previous_hub, previous)
+    
+    def region(self):
+        if self.viewport is None:
+            width, height = capture_source.size()
+            return 0, 0, width, height
+        return self.viewport[2:]
+    
+    def set_viewport(self, args):
+        # "lebar tinggi [x y w h]": ukuran jendela client dan region layar
+        # (koordinat layar server) yang ingin ditampilkan di jendela itu
+        try:
+            values = [int(value) for value in args.split()]
+        except ValueError:
+            return
+        if len(values) not in (2, 6) or min(values[:2]) <= 0:
+            return
+        screen_width, screen_height = capture_source.size()
+        x, y, w, h = values[2:] or (0, 0, screen_width, screen_height)
+        x = min(max(0, x), screen_width - 1)
+        y = min(max(0, y), screen_height - 1)
+        w = min(max(1, w), screen_width - x)
+        h = min(max(1, h), screen_height - y)
+        viewport = (values[0], values[1], x, y, w, h)
+        if viewport == self.viewport:
+            return
+        self.viewport = viewport
+        logging.info(f"Viewport {self.addr}: {w}x{h}+{x}+{y} ke jendela {values[0]}x{values[1]}")
+        if self.subscription is not None:
+            self.subscribe()
+    
+    def set_tile_cache(self, args):
+        # Kapasitas cermin tidak boleh melebihi cache client
+        try:
+            entries = min(int(args), TILE_CACHE_ENTRIES)
+        except ValueError:
+            return
+        self.tile_cache = protocol.TileCache(entries) if entries > 0 else None
+    
+    def send_cursor(self, position):
+        if self.cursor:
+            x, y = position
+            width, height = capture_source.size()
+            payload = protocol.CURSOR_PAYLOAD.pack(int(x), int(y), 1)
+            self.send_control(
+                self.header(protocol.FRAME_CURSOR, len(payload), width, height) + payload, protocol.CHANNEL_CURSOR)
+    
+    def send_heartbeat(self):
+        # Client lama tidak punya jenis frame untuk ini, jadi hanya FRAME_V2
+        if self.header_v2:
+            self.send_control(self.header(
+                protocol.FRAME_HEARTBEAT, 0, seq=self.frame_seq(), captured=self.subscription.captured))
+    
+    def send_ping(self):
+        if self.adaptive:
+            self.send_message(protocol.FRAME_PING, protocol.pack_ping(time.monotonic_ns()))
+    
+    def send_clock(self, args):
+        # Balasan PING dari client: waktu kirimnya dikembalikan bersama jam server
+        try:
+            sent = int(args)
+        except ValueError:
+            logging.warning(f"PING tidak valid dari {self.addr}: {args}")
+            return
+        payload = protocol.CLOCK_PAYLOAD.pack(sent, time.monotonic_ns() // 1000)
+        self.send_message(protocol.FRAME_CLOCK, payload)
+    
+    def send_metrics(self):
+        self.send_message(protocol.FRAME_STATS, protocol.pack_stats(metrics_snapshot()))
+    
+    def snapshot(self):
+        return {
+            "addr": f"{self.addr[0]}:{self.addr[1]}",
+            "rtt_ms": round(self.rtt_ms, 1),
+            "client_fps": self.client_fps,
+            "client_kbps": self.client_kbps,
+            "client_latency_ms": self.client_latency_ms,
+            "client_dropped": self.client_dropped,
+            "dropped": self.subscription.dropped if self.subscription else 0,
+            "backlog": self.backlog(),
+            "tile_cache": None if self.tile_cache is None else {
+                "entries": len(self.tile_cache), "hits": self.tile_cache.hits, "misses": self.tile_cache.misses},
+        }
+    
+    def on_pong(self, args):
+        try:
+            self.rtt_ms = (time.monotonic_ns() - int(args)) / 1e6
+        except ValueError:
+            logging.warning(f"PONG tidak valid dari {self.addr}: {args}")
+    
+    def on_stats(self, args):
+        # STATS fps kbps [latensi_ms dropped]; dua field terakhir dari client FRAME_V2
+        try:
+            values = args.split()
+            self.client_fps = float(values[0])
+            self.client_kbps = float(values[1])
+            if len(values) >= 4:
+                self.client_latency_ms = float(values[2]) if values[2] != "-" else None
+                self.client_dropped = int(values[3])
+            self.adaptive = True
+        except (ValueError, IndexError):
+            logging.warning(f"STATS tidak valid dari {self.addr}: {args}")
+    
+    def congestion(self):
+        # Kembalikan alasan jika koneksi ini tertekan pada interval terakhir
+        elapsed = max(time.time() - self.window_start, 1e-3)
+        sent_fps = self.window_frames / elapsed
+        dropped = self.subscription.dropped - self.window_dropped if self.subscription else 0
+        backlog = self.window_backlog
+        
+        self.window_frames = 0
+        self.window_dropped += dropped
+        self.window_backlog = self.backlog()
+        self.window_start = time.time()
+        
+        if backlog >= OUTBOX_HIGH_WATER or dropped > 0:
+            return f"antrian {self.addr}: {backlog / 1024:.0f} KB, dilewati {dropped}"
+        if not self.adaptive:
+            return None
+        if self.rtt_ms > TARGET_LATENCY_MS:
+            return f"RTT {self.addr}: {self.rtt_ms:.0f} ms"
+        if TARGET_BANDWIDTH_KBPS and self.client_kbps > TARGET_BANDWIDTH_KBPS:
+            return f"bandwidth {self.addr}: {self.client_kbps:.0f} KB/s"
+        if sent_fps > 2 and self.client_fps < 0.7 * sent_fps:
+            return f"FPS client {self.addr}: {self.client_fps:.1f}/{sent_fps:.1f}"
+        return None
+    
+    def log_stats(self, elapsed):
+        logging.info(
+            f"Frame rate {self.addr}: {self.frames_sent / elapsed:.1f} FPS, "
+            f"{self.bytes_sent / elapsed / 1024:.1f} KB/s, "
+            f"dilewati: {self.subscription.dropped}, "
+            f"antrian maks: {self.peak_backlog / 1024:.0f} KB"
+            + (f", latensi client: {self.client_latency_ms:.0f} ms" if self.client_latency_ms is not None else "")
+        )
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.peak_backlog = 0
+    
+    async def run(self):
+        # Client baru biasanya langsung mengirim CAPS (atau RESUME), jadi frame
+        # pertama sudah memakai header dan fitur yang didukungnya
+        try:
+            await asyncio.wait_for(self.greeted.wait(), HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        if self.subscription is None:
+            self.subscribe()
+        active_outboxes.add(self)
+        pump = asyncio.create_task(self.pump())
+        try:
+            if self.resume_seq is not None:
+                self.resend()
+            await self.send_frames()
+        finally:
+            pump.cancel()
+    
+    async def send_frames(self):
+        last_stats_report = time.time()
+        
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                self.send_heartbeat()
+                continue
+            self.wake.clear()
+            
+            if self.queues[protocol.CHANNEL_FRAMES]:
+                # Frame sebelumnya masih dikirim per chunk; write_chunk
+                # membangunkan loop ini begitu selesai
+                continue
+            if not self.channels and self.backlog() >= OUTBOX_HIGH_WATER:
+                await self.writer.drain()
+            
+            waited = time.perf_counter() - self.subscription.since
+            update = self.hub.take(self.subscription)
+            if update is not None:
+                stage_timings.record("queue", waited)
+                self.write_frame(update)
             
-            if current_time - last_frame_time >= min_frame_interval:
+            current_time = time.time()
+            if current_time - last_stats_report >= 5.0:
+                self.log_stats(current_time - last_stats_report)
+                last_stats_report = current_time
+    
+    def park(self):
+        # Subscription (beserta update yang tergabung selama putus), cermin
+        # tile cache dan sent_log disimpan; hub tetap di-encode seperti biasa
+        active_outboxes.discard(self)
+        parked_sessions[self.token] = self
+        self.expiry = asyncio.get_running_loop().call_later(SESSION_GRACE, self.expire)
+        logging.info(f"Sesi {self.addr} disimpan {SESSION_GRACE:.0f} detik untuk resume")
+    
+    def take_over(self):
+        # Koneksi lama belum terdeteksi putus (misalnya client berpindah
+        # jaringan Wi-Fi) saat client sudah menyambung ulang: pengirimnya
+        # dihentikan dan socketnya ditutup, handle_client lama tidak lagi
+        # menyentuh outbox ini karena task-nya bukan miliknya
+        self.task.cancel()
+        self.task = None
+        self.writer.close()
+        active_outboxes.discard(self)
+        logging.info(f"Sesi {self.addr} diambil alih koneksi baru")
+    
+    def expire(self):
+        if parked_sessions.pop(self.token, None) is self:
+            logging.info(f"Sesi {self.addr} kedaluwarsa")
+            self.close()
+    
+    def close(self):
+        active_outboxes.discard(self)
+        if self.subscription is not None:
+            frame_hubs.unsubscribe(self.hub, self.subscription)
+            if self.subscription.dropped:
+                logging.info(f"Frame dilewati untuk {self.addr}: {self.subscription.dropped}")
+
+class PynputInjector:
+    # Injector nyata; nama tombol protokol dipetakan ke Key pynput
+    name = "pynput"
+    
+    def __init__(self):
+        self.mouse = MouseController()
+        self.keyboard = KeyboardController()
+    
+    def key(self, name):
+        if name in SPECIAL_KEYS:
+            return SPECIAL_KEYS[name]
+        return name if len(name) == 1 else None
+    
+    def move(self, x, y):
+        self.mouse.position = (x, y)
+    
+    def click(self, button):
+        self.mouse.click(MOUSE_BUTTONS.get(button, MOUSE_BUTTONS[1]))
+    
+    def scroll(self, amount):
+        self.mouse.scroll(0, amount)
+    
+    def press(self, name):
+        key = self.key(name)
+        if key is not None:
+            self.keyboard.press(key)
+    
+    def release(self, name):
+        key = self.key(name)
+        if key is not None:
+            self.keyboard.release(key)
+    
+    def type_text(self, text):
+        self.keyboard.type(text)
+
+class NullInjector:
+    # Event dihitung tetapi tidak dieksekusi
+    name = "null"
+    
+    def __init__(self):
+        self.events = 0
+    
+    def record(self, *event):
+        self.events += 1
+    
+    def move(self, x, y):
+        self.record("move", x, y)
+    
+    def click(self, button):
+        self.record("click", button)
+    
+    def scroll(self, amount):
+        self.record("scroll", amount)
+    
+    def press(self, name):
+        self.record("press", name)
+    
+    def release(self, name):
+        self.record("release", name)
+    
+    def type_text(self, text):
+        self.record("type", text)
+
+class RecordingInjector(NullInjector):
+    # Menyimpan (waktu, event) yang diterima, untuk benchmark dan pengujian
+    name = "recording"
+    
+    def __init__(self):
+        super().__init__()
+        self.log = []
+    
+    def record(self, *event):
+        self.events += 1
+        self.log.append((time.perf_counter(), event))
+
+INPUT_INJECTORS = {injector.name: injector for injector in (PynputInjector, NullInjector, RecordingInjector)}
+
+def create_injector(name):
+    if name == PynputInjector.name and MouseController is None:
+        logging.warning("pynput tidak tersedia, input dari client tidak dieksekusi")
+        name = NullInjector.name
+    return INPUT_INJECTORS[name]()
+
+def inject_move(injector, state, position):
+    injector.move(*position)
+
+def inject_click(injector, state, button):
+    injector.click(button)
+
+def inject_scroll(injector, state, amount):
+    injector.scroll(amount)
+
+def inject_key_down(injector, state, key):
+    if key is not None and key not in state.pressed:
+        injector.press(key)
+        state.pressed.add(key)
+
+def inject_key_up(injector, state, key):
+    if key is not None:
+        injector.release(key)
+        state.pressed.discard(key)
+
+def inject_key_press(injector, state, key):
+    if key is not None:
+        injector.press(key)
+        injector.release(key)
+
+def inject_text(injector, state, text):
+    injector.type_text(text)
+
+def inject_release_all(injector, state, args):
+    # Tombol yang masih tertekan saat client terputus
+    for key in state.pressed:
+        try:
+            injector.release(key)
+        except Exception:
+            pass
+    state.pressed.clear()
+
+INPUT_HANDLERS = {
+    "MOUSE_MOVE": inject_move,
+    "MOUSE_CLICK": inject_click,
+    "MOUSE_SCROLL": inject_scroll,
+    "KEY_DOWN": inject_key_down,
+    "KEY_UP": inject_key_up,
+    "KEY_PRESS": inject_key_press,
+    "TYPE_TEXT": inject_text,
+    "RELEASE_ALL": inject_release_all,
+}
+
+class InputExecutor:
+    # Semua injeksi input berjalan di satu thread tersendiri: event loop tidak
+    # pernah menunggu injector, dan input tidak menunggu pengiriman frame.
+    # Event diambil per batch, MOUSE_MOVE berturut-turut digabung. Tahap
+    # "input" mencatat waktu sejak event diterima sampai selesai diinjeksi.
+    def __init__(self, injector):
+        self.injector = injector
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True, name="input")
+        self.thread.start()
+    
+    def submit(self, state, cmd_type, args):
+        self.queue.put((cmd_type, args, state, time.perf_counter()))
+    
+    def stop(self):
+        self.queue.put(None)
+    
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
                 try:
-                    img_data, width, height = screenshot_queue.get_nowait()
-                    
-                    header = struct.pack("QII", len(img_data), width, height)
-                    if not safe_send(conn, header):
-                        logging.error("Gagal mengirim header gambar")
-                        break
-                    
-                    if not safe_send(conn, img_data):
-                        logging.error("Gagal mengirim data gambar")
-                        break
-                    
-                    last_frame_time = current_time
-                    frame_counter += 1
-                    
-                    if current_time - last_fps_report >= 5.0:
-                        fps = frame_counter / (current_time - last_fps_report)
-                        logging.info(f"Frame rate: {fps:.1f} FPS")
-                        frame_counter = 0
-                        last_fps_report = current_time
-                    
+                    batch.append(self.queue.get_nowait())
                 except queue.Empty:
-                    pass
-                except Exception as e:
-                    logging.error(f"Error saat mengirim frame: {e}")
+                    break
             
+            events = [event for event in batch if event is not None]
+            for cmd_type, args, state, received in protocol.coalesce_moves(events):
+                try:
+                    INPUT_HANDLERS[cmd_type](self.injector, state, args)
+                except Exception as e:
+                    logging.error(f"Error saat menginjeksi {cmd_type}: {e}")
+                stage_timings.record("input", time.perf_counter() - received)
+            if len(events) < len(batch):
+                return
+
+def metrics_snapshot():
+    return {
+        "time": time.time(),
+        "stages": stage_timings.summary(),
+        "viewers": [outbox.snapshot() for outbox in active_outboxes],
+    }
+
+async def metrics_dump_loop(path):
+    # Ditulis ke file sementara lalu di-rename agar pembaca tidak melihat JSON setengah jadi
+    while not stop_event.is_set():
+        await asyncio.sleep(METRICS_INTERVAL)
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump(metrics_snapshot(), f, indent=2)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.error(f"Gagal menulis metrics ke {path}: {e}")
+
+class InputState:
+    # State input per client; pressed hanya disentuh thread InputExecutor
+    def __init__(self):
+        self.screen_width, self.screen_height = capture_source.size()
+        self.pressed = set()
+    
+    def release_all(self):
+        input_executor.submit(self, "RELEASE_ALL", None)
+
+def parse_command(item):
+    # Ubah event biner atau baris teks menjadi (tipe, argumen) yang sudah di-parse
+    if isinstance(item, tuple):
+        cmd_type, a, b, w, h = item
+        if cmd_type == "MOUSE_MOVE":
+            return cmd_type, (a, b, w or None, h or None)
+        if cmd_type.startswith("KEY_"):
+            return cmd_type, protocol.decode_key(a)
+        return cmd_type, a
+    
+    parts = item.strip().split(' ', 1)
+    cmd_type = parts[0]
+    args = parts[1] if len(parts) > 1 else ""
+    
+    try:
+        if cmd_type == "MOUSE_MOVE":
+            coords = [int(c) for c in args.split()]
+            if len(coords) < 2:
+                return None
+            coords += [None] * (4 - len(coords))
+            return cmd_type, tuple(coords[:4])
+        if cmd_type == "MOUSE_CLICK":
+            return cmd_type, int(args)
+        if cmd_type == "MOUSE_SCROLL":
             try:
-                recv_data = conn.recv(1024).decode()
-                
-                if not recv_data:
-                    logging.info("Client terputus (tidak ada data)")
-                    break
-                
-                last_activity_time = current_time
-                
-                command_buffer += recv_data
-                
-                while '\n' in command_buffer:
-                    command, command_buffer = command_buffer.split('\n', 1)
-                    command = command.strip()
-                    
-                    if not command:
-                        continue
-                    
-                    parts = command.split(' ', 1)
-                    cmd_type = parts[0]
-                    args = parts[1] if len(parts) > 1 else ""
-                    
-                    if cmd_type == "MOUSE_MOVE":
-                        try:
-                            coords = args.split()
-                            if len(coords) >= 2:
-                                client_x, client_y = int(coords[0]), int(coords[1])
-                                client_width = int(coords[2]) if len(coords) > 2 else screen_width
-                                client_height = int(coords[3]) if len(coords) > 3 else screen_height
-                                
-                                target_x = int(client_x * screen_width / client_width)
-                                target_y = int(client_y * screen_height / client_height)
-                                mouse.position = (target_x, target_y)
-                        except ValueError as e:
-                            logging.warning(f"Kesalahan parsing koordinat mouse: {e}")
-
-                    elif cmd_type == "MOUSE_CLICK":
-                        try:
-                            button_num = int(args)
-                            
-                            button_map = {
-                                1: MouseButton.left,
-                                2: MouseButton.middle,
-                                3: MouseButton.right
-                            }
-                            
-                            button = button_map.get(button_num, MouseButton.left)
-                            
-                            mouse.click(button)
-                        except ValueError as e:
-                            logging.warning(f"Error saat memproses klik mouse: {e}")
-
-                    elif cmd_type == "MOUSE_SCROLL":
-                        try:
-                            scroll_amount = int(args)
-                            pyautogui.scroll(scroll_amount) 
-                        except ValueError:
-                            direction = args
-                            scroll_amount = 5 if direction == "UP" else -5
-                            pyautogui.scroll(scroll_amount)
-
-                    elif cmd_type == "KEY_DOWN":
-                        key = args
-                        if key in SPECIAL_KEYS:
-                            k = SPECIAL_KEYS[key]
-                            keyboard.press(k)
-                            key_states[key] = k
-                        elif len(key) == 1:  
-                            keyboard.press(key)
-                            key_states[key] = key
-                    
-                    elif cmd_type == "KEY_UP":
-                        key = args
-                        if key in key_states:
-                            keyboard.release(key_states[key])
-                            del key_states[key]
-                        elif key in SPECIAL_KEYS:
-                            keyboard.release(SPECIAL_KEYS[key])
-                    
-                    elif cmd_type == "KEY_PRESS":
-                        key = args
-                        if key in SPECIAL_KEYS:
-                            keyboard.press(SPECIAL_KEYS[key])
-                            keyboard.release(SPECIAL_KEYS[key])
-                        elif len(key) == 1:  
-                            keyboard.press(key)
-                            keyboard.release(key)
-                    
-                    elif cmd_type == "PING":
-                        if not safe_send(conn, "PONG\n".encode()):
-                            logging.error("Gagal mengirim PONG")
-                            connection_active = False
-                        
-            except socket.timeout:
-                if current_time - last_activity_time > 30:  
-                    logging.warning(f"Koneksi idle selama 30 detik, mengirim ping")
-                    if not safe_send(conn, "PING\n".encode()):
-                        logging.error("Koneksi terputus (ping gagal)")
-                        connection_active = False
-                    last_activity_time = current_time
-            except ConnectionResetError:
-                logging.error("Koneksi terputus (reset oleh peer)")
-                connection_active = False
-            except BrokenPipeError:
-                logging.error("Koneksi terputus (pipe rusak)")
-                connection_active = False
-            except Exception as e:
-                logging.error(f"Error saat menerima data: {e}")
-                time.sleep(0.1)
-                
-            time.sleep(0.01)
+                return cmd_type, int(args)
+            except ValueError:
+                return cmd_type, 5 if args == "UP" else -5
+        if cmd_type == "TYPE_TEXT":
+            text = json.loads(args)
+            return (cmd_type, text) if isinstance(text, str) and text else None
+    except ValueError as e:
+        logging.warning(f"Kesalahan parsing perintah {cmd_type}: {e}")
+        return None
+    
+    return (cmd_type, args) if cmd_type else None
+
+def process_command(cmd_type, args, state, outbox):
+    if cmd_type == "MOUSE_MOVE":
+        client_x, client_y, client_width, client_height = args
+        # Koordinat jendela client dipetakan ke region viewport-nya saat
+        # diterima, karena viewport bisa berubah sebelum event diinjeksi
+        region_x, region_y, region_width, region_height = outbox.region()
+        client_width = client_width or region_width
+        client_height = client_height or region_height
+        
+        target_x = region_x + int(client_x * region_width / client_width)
+        target_y = region_y + int(client_y * region_height / client_height)
+        input_executor.submit(state, cmd_type, (target_x, target_y))
+    
+    elif cmd_type in INPUT_HANDLERS:
+        input_executor.submit(state, cmd_type, args)
+    
+    elif cmd_type == "PING":
+        if args and outbox.header_v2:
+            outbox.send_clock(args)
+        elif not outbox.header_v2:
+            outbox.send_control("PONG\n".encode())
+    
+    elif cmd_type == "CAPS":
+        outbox.set_capabilities(args.split())
+    
+    elif cmd_type == "CACHE":
+        outbox.set_tile_cache(args)
+    
+    elif cmd_type == "VIEWPORT":
+        outbox.set_viewport(args)
+    
+    elif cmd_type == "ACK":
+        outbox.on_ack(args)
+    
+    elif cmd_type == "PONG":
+        outbox.on_pong(args)
+    
+    elif cmd_type == "STATS":
+        outbox.on_stats(args)
+    
+    elif cmd_type == "METRICS":
+        outbox.send_metrics()
+
+SERVER_CAPABILITIES = [
+    protocol.CAP_BINARY_INPUT, protocol.CAP_FRAME_HEADER, protocol.CAP_CURSOR, protocol.CAP_PALETTE,
+    protocol.CAP_COPY_RECT, protocol.CAP_TILE_CACHE, protocol.CAP_VIEWPORT, protocol.CAP_CHANNELS,
+    protocol.CAP_TYPE_TEXT, protocol.CAP_RESUME, protocol.CAP_MOTION,
+]
+
+def resume_session(args, writer, addr):
+    # "RESUME <token hex> <seq>": sesi yang di-park atau yang koneksinya masih
+    # dianggap aktif, atau None bila tidak ada (kedaluwarsa, server restart)
+    # sehingga client mendapat sesi baru
+    try:
+        token_hex, seq = args.split()
+        token, seq = bytes.fromhex(token_hex), int(seq)
+    except ValueError:
+        return None
+    outbox = parked_sessions.pop(token, None)
+    if outbox is not None:
+        outbox.expiry.cancel()
+    else:
+        outbox = next((active for active in active_outboxes if active.token == token), None)
+        if outbox is None or outbox.writer is writer:
+            return None
+        outbox.take_over()
+    if not outbox.attach(writer, addr, seq):
+        logging.info(f"Sesi {outbox.addr} tidak bisa dilanjutkan dari seq {seq}, dimulai baru")
+        outbox.close()
+        return None
+    return outbox
+
+async def handle_client(reader, writer):
+    addr = writer.get_extra_info("peername")
+    logging.info(f"Koneksi dari {addr}")
+    
+    state = InputState()
+    logging.info(f"Ukuran layar: {state.screen_width}x{state.screen_height}")
+    
+    outbox = ClientOutbox(writer, addr)
+    frame_task = None
+    
+    try:
+        outbox.send_control(
+            f"CONFIG {state.screen_width} {state.screen_height} {' '.join(SERVER_CAPABILITIES)}\n".encode())
+        frame_task = outbox.task = asyncio.create_task(outbox.run())
+        
+        command_buffer = b""
+        
+        while not stop_event.is_set():
+            try:
+                recv_data = await asyncio.wait_for(reader.read(4096), IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.warning(f"Koneksi idle selama {IDLE_TIMEOUT:.0f} detik, mengirim ping")
+                if outbox.header_v2:
+                    outbox.send_message(protocol.FRAME_PING, protocol.pack_ping(time.monotonic_ns()))
+                else:
+                    outbox.send_control("PING\n".encode())
+                continue
+            
+            if not recv_data:
+                logging.info("Client terputus (tidak ada data)")
+                break
+            if outbox.task is not frame_task:
+                # Sesi sudah dilanjutkan oleh koneksi lain lewat RESUME
+                break
+            
+            items, command_buffer = protocol.split_input(command_buffer + recv_data)
+            
+            commands = [command for command in map(parse_command, items) if command]
+            for cmd_type, args in protocol.coalesce_moves(commands):
+                if cmd_type == "RESUME":
+                    resumed = resume_session(args, writer, addr)
+                    if resumed is not None:
+                        # Outbox baru belum pernah subscribe (masih menunggu greeted)
+                        frame_task.cancel()
+                        outbox.close()
+                        outbox = resumed
+                        frame_task = outbox.task = asyncio.create_task(outbox.run())
+                    continue
+                if session_recorder is not None and cmd_type in INPUT_HANDLERS:
+                    session_recorder.record_input(addr, cmd_type, args)
+                process_command(cmd_type, args, state, outbox)
+            outbox.greeted.set()
+            
+            if frame_task.done():
+                break
 
+    except ConnectionResetError:
+        logging.error("Koneksi terputus (reset oleh peer)")
+    except BrokenPipeError:
+        logging.error("Koneksi terputus (pipe rusak)")
     except Exception as e:
         logging.error(f"Error dalam handle_client: {e}")
         import traceback
         logging.error(traceback.format_exc())
     finally:
-        for k in key_states.values():
-            try:
-                keyboard.release(k)
-            except:
-                pass
+        if frame_task is not None:
+            frame_task.cancel()
+        if outbox.task is not frame_task:
+            # Sesi sudah dipegang koneksi baru lewat RESUME
+            pass
+        elif outbox.token is not None and not stop_event.is_set():
+            outbox.park()
+        else:
+            outbox.close()
+        
+        state.release_all()
         
         try:
-            conn.close()
+            writer.close()
         except:
             pass
         logging.info(f"Koneksi dari {addr} ditutup")
 
+async def serve(capture_backend=CAPTURE_BACKEND, capture_options=None):
+    global capture_source, cursor_controller, session_recorder, input_executor
+    
+    try:
+        server_socket = create_server_socket()
+    except OSError as e:
+        logging.error(f"Gagal membuat socket server: {e}")
+        sys.exit(1)
+    
+    # Backend dibuat di thread capture karena beberapa grabber (mss) terikat ke thread
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture")
+    capture_source = await asyncio.get_running_loop().run_in_executor(
+        executor, lambda: capture.create_capture(capture_backend, **(capture_options or {})))
+    
+    input_executor = InputExecutor(create_injector(INPUT_INJECTOR))
+    if input_executor.injector.name == PynputInjector.name:
+        cursor_controller = MouseController()
+    
+    capture_task = asyncio.create_task(capture_loop(executor))
+    cursor_task = asyncio.create_task(cursor_loop())
+    metrics_task = asyncio.create_task(metrics_dump_loop(METRICS_FILE)) if METRICS_FILE else None
+    record_task = None
+    if RECORD_FILE:
+        session_recorder = SessionRecorder(RECORD_FILE)
+        record_task = asyncio.create_task(session_recorder.run())
+    
+    server = await asyncio.start_server(handle_client, sock=server_socket)
+    logging.info(f"Server berjalan di {HOST}:{PORT}")
+    logging.info("Menunggu koneksi dari client...")
+    
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        stop_event.set()
+        capture_task.cancel()
+        cursor_task.cancel()
+        if metrics_task is not None:
+            metrics_task.cancel()
+        if record_task is not None:
+            record_task.cancel()
+            session_recorder.close()
+        input_executor.stop()
+        executor.submit(capture_source.close)
+        executor.shutdown(wait=False)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Remote desktop server")
+    parser.add_argument("--capture", choices=sorted(capture.CAPTURE_BACKENDS), default=CAPTURE_BACKEND,
+                        help="backend capture layar")
+    parser.add_argument("--scene", choices=capture.SyntheticCapture.scenes, default="desktop",
+                        help="skenario untuk backend synthetic")
+    parser.add_argument("--size", default="1920x1080",
+                        help="resolusi untuk backend synthetic, mis. 1280x720")
+    parser.add_argument("--input", choices=sorted(INPUT_INJECTORS), default=INPUT_INJECTOR,
+                        help="injector input; null menerima input tanpa mengeksekusinya")
+    parser.add_argument("--metrics-file", default=METRICS_FILE,
+                        help=f"tulis statistik tahap pipeline ke file JSON setiap {METRICS_INTERVAL:.0f} detik")
+    parser.add_argument("--motion-codec", choices=sorted(MOTION_CODECS) + ["jpeg"], default=MOTION_CODEC,
+                        help="kodek untuk tile yang terus berubah (video, animasi); jpeg = tanpa kodek temporal")
+    parser.add_argument("--record", default=RECORD_FILE,
+                        help="rekam stream layar, kursor dan input ke file untuk replay.py")
+    return parser.parse_args()
+
 def main():
+    global INPUT_INJECTOR, METRICS_FILE, RECORD_FILE, MOTION_CODEC
+    
+    args = parse_args()
+    INPUT_INJECTOR = args.input
+    MOTION_CODEC = args.motion_codec
+    METRICS_FILE = args.metrics_file
+    RECORD_FILE = args.record
+    capture_options = {}
+    if args.capture == "synthetic":
+        width, height = (int(v) for v in args.size.lower().split("x"))
+        capture_options = {"width": width, "height": height, "scene": args.scene}
+    
     try:
-        screenshot_thread = threading.Thread(target=screenshot_worker, daemon=True)
-        screenshot_thread.start()
-        
-        while not stop_event.is_set():
-            try:
-                
-                server_socket.settimeout(1.0)
-                try:
-                    conn, addr = server_socket.accept()
-                    
-                    client_thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
-                    client_thread.start()
-                except socket.timeout:
-                    continue
-            except KeyboardInterrupt:
-                logging.info("Server dihentikan oleh pengguna")
-                stop_event.set()
-                break
-            except Exception as e:
-                logging.error(f"Error saat menerima koneksi: {e}")
-                time.sleep(1)  
-            
+        asyncio.run(serve(args.capture, capture_options))
     except KeyboardInterrupt:
         logging.info("Server dihentikan oleh pengguna")
     except Exception as e:
@@ -345,10 +1879,6 @@ def main():
         logging.error(traceback.format_exc())
     finally:
         stop_event.set() 
-        try:
-            server_socket.close()
-        except:
-            pass
         logging.info("Server ditutup")
 
 if __name__ == "__main__":
@@ -0,0 +1,36 @@
+import protocol
+import server
+
+WIDTH, HEIGHT = 128, 64
+LEFT = (0, 0, 64, 64)
+RIGHT = (64, 0, 64, 64)
+
+
+def jpeg(rect, data=b"jpeg"):
+    return (*rect, protocol.ENC_JPEG, data)
+
+
+def copy(rect, source):
+    return (*rect, protocol.ENC_COPY, protocol.COPY_SOURCE.pack(*source))
+
+
+def test_copy_from_older_packet_is_not_a_keyframe():
+    # P1 mengubah tile kanan; update berikutnya (yang tergabung di antrean
+    # server) menyalin tile kanan ke kiri lalu mengubah tile kanan lagi. COPY
+    # membaca isi P1, jadi paket gabungan tidak boleh membuat P1 dilewati.
+    pending = server.merge_update(None, [jpeg(LEFT, b"L2")], WIDTH, HEIGHT)
+    merged = server.merge_update(pending, [copy(LEFT, RIGHT[:2]), jpeg(RIGHT, b"R3")], WIDTH, HEIGHT)
+    assert [rect[4] for rect in merged[0]] == [protocol.ENC_JPEG, protocol.ENC_COPY, protocol.ENC_JPEG]
+    assert not protocol.covers_frame(merged[0], WIDTH, HEIGHT)
+
+
+def test_copy_after_full_coverage_is_a_keyframe():
+    rects = [jpeg(LEFT), jpeg(RIGHT), copy(LEFT, RIGHT[:2])]
+    assert protocol.covers_frame(rects, WIDTH, HEIGHT)
+
+
+def test_motion_before_coverage_is_not_a_keyframe():
+    motion = (*LEFT, protocol.ENC_MOTION, b"")
+    assert not protocol.covers_frame([motion, jpeg(RIGHT)], WIDTH, HEIGHT)
+    assert not protocol.covers_frame([motion, jpeg(LEFT), jpeg(RIGHT)], WIDTH, HEIGHT)
+    assert protocol.covers_frame([jpeg(LEFT), jpeg(RIGHT), motion], WIDTH, HEIGHT)